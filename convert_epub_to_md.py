@@ -1,16 +1,34 @@
 import re
-from markdownify import markdownify as md
+from markdownify import MarkdownConverter
+
+# Pre-compiled patterns shared by the Markdown cleanup functions
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+LEADING_TAG_RE = re.compile(r'\s*<')  # Content starting with a tag is HTML, not Markdown
+HEADING_LINE_RE = re.compile(r'^[^\S\n]*#.*$', flags=re.MULTILINE)
+CLEANUP_TEXT_RE = re.compile(r'^\s*(?:<\?xml|<!DOCTYPE)|[™©®]')  # Text nodes clean_markdown_text() edits
+SOURCE_TAG_NAME_RE = re.compile(r'</?([a-z][^\s/>]*)')  # Tag names in (lowercased) HTML source
+
+# Shared markdownify converter for clean_markdown_text()
+MARKDOWN_CONVERTER = MarkdownConverter(
+    heading_style="ATX",  # Use # style headings
+    em_symbol="*",        # Use * for italic (since we already converted <i>/<em>)
+    strong_symbol="**",   # Use ** for bold (since we already converted <b>/<strong>)
+    code_symbol="`",      # Use ` for inline code
+    bullets="-",          # Use - for bullet lists
+    strip=['script', 'style']  # Remove script and style tags
+)
+
+# Words that should remain lowercase in titles (unless first or last word)
+MINOR_WORDS = frozenset({
+    'a', 'an', 'and', 'as', 'at', 'but', 'by', 'for', 'if', 'in', 'is', 'it', 'no', 'nor', 
+    'of', 'on', 'or', 'so', 'the', 'to', 'up', 'yet', 'with', 'from', 'into', 'through', 
+    'during', 'before', 'after', 'above', 'below', 'between', 'among', 'within', 'without'
+})
+NON_WORD_RE = re.compile(r'[^\w]')
 
 def title_case(text: str) -> str:
     """Convert text to Title Case (first letter of major words capitalized)."""
     
-    # Words that should remain lowercase (unless first or last word)
-    minor_words = {
-        'a', 'an', 'and', 'as', 'at', 'but', 'by', 'for', 'if', 'in', 'is', 'it', 'no', 'nor', 
-        'of', 'on', 'or', 'so', 'the', 'to', 'up', 'yet', 'with', 'from', 'into', 'through', 
-        'during', 'before', 'after', 'above', 'below', 'between', 'among', 'within', 'without'
-    }
-    
     # If text is all uppercase, convert to title case first
     if text.isupper():
         text = text.title()
@@ -21,17 +39,21 @@ def title_case(text: str) -> str:
         return text
     
     result = []
+    last = len(words) - 1
     for i, word in enumerate(words):
-        # Clean the word (remove punctuation for processing)
-        clean_word = re.sub(r'[^\w]', '', word.lower())
+        # Clean the word (remove punctuation for processing); most words have none,
+        # and str.isalnum() covers exactly the \w characters bar '_'
+        clean_word = word.lower()
+        if not clean_word.isalnum():
+            clean_word = NON_WORD_RE.sub('', clean_word)
         
         # Capitalize if:
         # 1. It's the first or last word
         # 2. It's not a minor word
         # 3. It's longer than 3 characters (to catch important short words)
         should_capitalize = (
-            i == 0 or i == len(words) - 1 or  # First or last word
-            clean_word not in minor_words or  # Not a minor word
+            i == 0 or i == last or  # First or last word
+            clean_word not in MINOR_WORDS or  # Not a minor word
             len(clean_word) > 3  # Longer than 3 characters
         )
         
@@ -49,11 +71,14 @@ def title_case(text: str) -> str:
 
 
 
+# Characters that can't appear in a filename, each mapped to '-'
+ILLEGAL_FILENAME_CHARS = str.maketrans(dict.fromkeys('\\/:"*?<>|', '-'))
+
 # Helper function to sanitize titles for filenames
 def safe_filename(title: str) -> str:
     """Sanitize title for use as a filename (prevent subfolders or illegal characters)."""
     # First sanitize the title
-    safe_title = re.sub(r'[\\/:"*?<>|]', '-', title)
+    safe_title = title.translate(ILLEGAL_FILENAME_CHARS)
     
     # Limit filename length to prevent filesystem errors
     # Most filesystems have a limit of 255 characters for filename
@@ -76,52 +101,51 @@ def clean_markdown_text(md_content: str, chapter_map=None) -> str:
     # === PHASE 1: PRE-PROCESS AND STANDARDIZE HTML ===
     
     # If we're already working with Markdown content (from Pandoc), skip HTML preprocessing
-    if not md_content.strip().startswith('<'):
+    if not LEADING_TAG_RE.match(md_content):
         # This is already Markdown, go straight to Phase 3
         return post_process_markdown(md_content, chapter_map)
     
     # Parse HTML with BeautifulSoup for preprocessing
-    from bs4 import BeautifulSoup
-    soup = BeautifulSoup(md_content, 'html.parser')
-    
-    # Remove XML declaration and processing instructions
-    for element in soup.find_all(text=True):
-        if isinstance(element, str) and element.strip().startswith('<?xml'):
-            element.extract()
-        elif isinstance(element, str) and element.strip().startswith('<!DOCTYPE'):
-            element.extract()
+    soup = BeautifulSoup(md_content, 'lxml')
+    # Tag names in the source, found in one C-level scan. The parser only adds implied
+    # html/head/body/p wrappers, so blocks whose tags aren't listed can be skipped
+    # without walking the tree.
+    source_tags = set(SOURCE_TAG_NAME_RE.findall(md_content.lower()))
     
     # === ENHANCED TAG HANDLING ===
     # Convert <i> and <em> to Markdown italic, <b> and <strong> to Markdown bold
     # This is more efficient than converting <i> to <em> first
     
     # Handle italic tags (<i> and <em>)
-    for tag in soup.find_all(['i', 'em']):
+    for tag in (soup.find_all(['i', 'em']) if source_tags & {'i', 'em'} else ()):
         try:
             if tag.name in ['i', 'em']:
                 # Replace with Markdown italic syntax
-                from bs4.element import NavigableString
                 tag.replace_with(NavigableString(f"*{tag.get_text()}*"))
         except (AttributeError, TypeError):
             continue
     
     # Handle bold tags (<b> and <strong>)
-    for tag in soup.find_all(['b', 'strong']):
+    for tag in (soup.find_all(['b', 'strong']) if source_tags & {'b', 'strong'} else ()):
         try:
             if tag.name in ['b', 'strong']:
                 # Replace with Markdown bold syntax
-                from bs4.element import NavigableString
                 tag.replace_with(NavigableString(f"**{tag.get_text()}**"))
         except (AttributeError, TypeError):
             continue
     
-    # === SYMBOL CLEANUP ===
-    # Remove trademark symbols and other special characters
-    for text in soup.find_all(text=True):
+    # === TEXT CLEANUP ===
+    # Single walk over the text nodes: drop XML declarations and processing
+    # instructions, and remove trademark symbols and other special characters.
+    # bs4 filters the strings against CLEANUP_TEXT_RE, so only nodes with work to do come back.
+    for text in soup.find_all(string=CLEANUP_TEXT_RE):
+        stripped = text.strip()
+        if stripped.startswith('<?xml') or stripped.startswith('<!DOCTYPE'):
+            text.extract()
+            continue
         try:
             if text.parent and hasattr(text.parent, 'name') and text.parent.name not in ['script', 'style']:
                 # Remove trademark symbols
-                from bs4.element import NavigableString
                 cleaned_text = text.replace('™', '').replace('©', '').replace('®', '')
                 if cleaned_text != text:
                     text.replace_with(NavigableString(cleaned_text))
@@ -130,7 +154,7 @@ def clean_markdown_text(md_content: str, chapter_map=None) -> str:
     
     # === FIGURE AND CAPTION HANDLING ===
     # Process figures and captions before general cleanup to preserve structure
-    for figure in soup.find_all('figure'):
+    for figure in (soup.find_all('figure') if 'figure' in source_tags else ()):
         try:
             # Extract image info
             img = figure.find('img')
@@ -140,9 +164,8 @@ def clean_markdown_text(md_content: str, chapter_map=None) -> str:
                 
                 # Fix image path: ensure it's images/filename.jpg format
                 if src:
-                    import os
                     # Get just the filename from the path
-                    image_filename = os.path.basename(src)
+                    image_filename = src.rpartition('/')[2]
                     # Ensure the path is images/filename format
                     new_src = f"images/{image_filename}"
                     img['src'] = new_src
@@ -159,16 +182,15 @@ def clean_markdown_text(md_content: str, chapter_map=None) -> str:
                         # Get the text content, ignoring the href
                         caption_text = a_tag.get_text(strip=True)
                         # Remove any remaining HTML tags
-                        caption_text = re.sub(r'<[^>]+>', '', caption_text)
+                        caption_text = HTML_TAG_RE.sub('', caption_text)
                         break
                     
                     if not caption_text:
                         # Fallback: get text from figcaption directly
                         caption_text = figcaption.get_text(strip=True)
-                        caption_text = re.sub(r'<[^>]+>', '', caption_text)
+                        caption_text = HTML_TAG_RE.sub('', caption_text)
                 
                 # Replace the entire figure with Markdown image and caption
-                from bs4.element import NavigableString
                 if caption_text:
                     figure.replace_with(NavigableString(f"{markdown_img}\n\n{caption_text}"))
                 else:
@@ -178,31 +200,28 @@ def clean_markdown_text(md_content: str, chapter_map=None) -> str:
     
     # Remove unwanted tags that don't carry semantic meaning
     unwanted_tags = ['span', 'div']
-    for tag in soup.find_all(unwanted_tags):
+    for tag in (soup.find_all(unwanted_tags) if source_tags.intersection(unwanted_tags) else ()):
         # Unwrap the tag but keep its content
         tag.unwrap()
     
-    # Special handling for span tags that cause unwanted line breaks
-    # Look for span tags that are breaking up paragraphs and merge them
-    for span in soup.find_all('span'):
-        if span.parent and span.parent.name == 'p':
-            # If span is inside a paragraph, unwrap it to prevent line breaks
-            span.unwrap()
-    
     # Remove empty paragraphs
     for p in soup.find_all('p'):
         if not p.get_text(strip=True):
             p.decompose()
     
     # Consolidate multiple <br> tags into single ones
-    for br in soup.find_all('br'):
+    for br in (soup.find_all('br') if 'br' in source_tags else ()):
         # If there are multiple consecutive <br> tags, keep only one
         next_sibling = br.next_sibling
         if next_sibling and next_sibling.name == 'br':
             br.decompose()
     
     # Remove EPUB-specific attributes and classes
+    # The same walk collects the <img> tags, as the tree doesn't change again after it
+    images = []
     for tag in soup.find_all(True):
+        if tag.name == 'img':
+            images.append(tag)
         # Remove XML namespaces and EPUB attributes
         attrs_to_remove = []
         for attr in tag.attrs:
@@ -214,31 +233,23 @@ def clean_markdown_text(md_content: str, chapter_map=None) -> str:
     
     # === PHASE 2: CONVERT TO MARKDOWN USING MARKDOWNIFY ===
     
-    # Convert the cleaned HTML to Markdown
-    markdown_text = md(
-        str(soup), 
-        heading_style="ATX",  # Use # style headings
-        em_symbol="*",        # Use * for italic (since we already converted <i>/<em>)
-        strong_symbol="**",   # Use ** for bold (since we already converted <b>/<strong>)
-        code_symbol="`",      # Use ` for inline code
-        bullets="-",          # Use - for bullet lists
-        strip=['script', 'style']  # Remove script and style tags
-    )
+    # Convert the cleaned HTML to Markdown, straight from the soup (no serialize + re-parse)
+    markdown_text = MARKDOWN_CONVERTER.convert_soup(soup)
     
     # === PHASE 1: FIX IMAGE PATHS AND EXTRACT POSITIONS ===
     # Correct all image paths and store their positions for later insertion
     image_positions = []
-    for img in soup.find_all('img'):
+    for img in images:
         src = img.get('src')
         if not src:
             continue
         
-        # Get just the filename from the original path (e.g., '../Images/photo.jpg' -> 'photo.jpg')
-        import os
-        image_filename = os.path.basename(src)
+        # Get just the filename from the original path (e.g., '../Images/photo.jpg' -> 'photo.jpg');
+        # EPUB paths always use '/', so no os.path round trip is needed
+        image_filename = src.rpartition('/')[2]
         
         # Set the new path to be relative to the 'images' folder
-        img['src'] = os.path.join('images', image_filename)
+        img['src'] = f"images/{image_filename}"
         
         # Store image info for later insertion with context
         alt = img.get('alt', 'figure')
@@ -274,322 +285,391 @@ def clean_markdown_text(md_content: str, chapter_map=None) -> str:
     
     return post_process_markdown(markdown_text, chapter_map, image_positions)
 
-def post_process_markdown(markdown_text: str, chapter_map=None, image_positions=None) -> str:
-    """
-    Phase 3: Post-process the Markdown for final polishing
-    """
-    
-    # === PROTECT IMPORTANT CONTENT ===
-    
-    # Protect links from modification
-    def protect_link(match):
-        link_text = match.group(1)
-        link_url = match.group(2)
-        return f"LINK_PLACEHOLDER_{link_text}_{link_url}"
-    
-    markdown_text = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', protect_link, markdown_text)
-    
-    # === CLEANUP AND FORMATTING ===
-    
+# === POST-PROCESSING RULES ===
+# (pattern, replacement) pairs applied in order by post_process_markdown(), compiled once
+# at import. The first set runs while links are protected by placeholders, the second
+# after the links have been restored. Rules are grouped under a literal that every rule
+# in the group needs to match; a group is skipped when its literal isn't in the text at
+# that point, since none of its rules could then change anything.
+MARKDOWN_LINK_RE = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
+LINK_PLACEHOLDER_RE = re.compile(r'LINK_PLACEHOLDER_([^_]+)_([^_]+)')
+MARKDOWN_IMAGE_RE = re.compile(r'!\[([^\]]+)\]\(([^)]+)\)')
+STRAY_PARENTHESES_FIXES = {
+    'position)': 'position',
+    'experiencing) perceiving': 'experiencing (perceiving',
+    'them) explicitly': 'them (explicitly',
+}
+STRAY_PARENTHESES_RE = re.compile(r'position\)$|experiencing\) perceiving|them\) explicitly', re.MULTILINE)
+
+POST_PROCESS_CLEANUP_RULES = (
     # Remove XML declarations from the final output
-    markdown_text = re.sub(r'^xml version="1\.0" encoding="UTF-8"\?\n?', '', markdown_text, flags=re.MULTILINE)
-    
+    ('xml version', (
+        (re.compile(r'^xml version="1\.0" encoding="UTF-8"\?\n?', re.MULTILINE), ''),
+    )),
     # Collapse multiple newlines into maximum of 2
-    markdown_text = re.sub(r'\n{3,}', '\n\n', markdown_text)
-    
+    ('\n\n\n', (
+        (re.compile(r'\n{3,}'), '\n\n'),
+    )),
     # Remove trailing whitespace from lines
-    markdown_text = re.sub(r' +\n', '\n', markdown_text)
-    
+    (' \n', (
+        (re.compile(r' +\n'), '\n'),
+    )),
     # Fix headings that got merged with paragraphs
     # Pattern: # Heading text (should be # Heading\n\ntext)
-    markdown_text = re.sub(r'^(#{1,6}\s+[^#\n]+)\s+([A-Z][a-z])', r'\1\n\n\2', markdown_text, flags=re.MULTILINE)
-    
+    ('#', (
+        (re.compile(r'^(#{1,6}\s+[^#\n]+)\s+([A-Z][a-z])', re.MULTILINE), r'\1\n\n\2'),
+    )),
     # Fix unwanted line breaks within sentences (but be more conservative)
     # Only fix when it's clearly a broken sentence, not across structural boundaries
     # Pattern: word\n\nword (where it should be word word) but only within paragraphs
-    markdown_text = re.sub(r'([a-z])\n\n([a-z])', r'\1 \2', markdown_text, flags=re.MULTILINE)
-    
+    ('\n\n', (
+        (re.compile(r'([a-z])\n\n([a-z])', re.MULTILINE), r'\1 \2'),
+    )),
     # Fix heading hierarchy - convert Activity headings to level 3
-    markdown_text = re.sub(r'^# Activity (\d+\.\d+)', r'### Activity \1', markdown_text, flags=re.MULTILINE)
-    
+    ('# Activity', (
+        (re.compile(r'^# Activity (\d+\.\d+)', re.MULTILINE), r'### Activity \1'),
+    )),
     # Fix table-to-heading conversions for activities
-    markdown_text = re.sub(r'^\|  \|  \|\n\| --- \| --- \|\n\| Activity (\d+\.\d+) \| figure \|', r'### Activity \1', markdown_text, flags=re.MULTILINE)
-    
-    # Fix other table-to-heading conversions
-    markdown_text = re.sub(r'^\|  \|  \|\n\| --- \| --- \|\n\| ([^|]+) \| figure \|', r'### \1', markdown_text, flags=re.MULTILINE)
-    
+    ('| figure |', (
+        (re.compile(r'^\|  \|  \|\n\| --- \| --- \|\n\| Activity (\d+\.\d+) \| figure \|', re.MULTILINE), r'### Activity \1'),
+        # Fix other table-to-heading conversions
+        (re.compile(r'^\|  \|  \|\n\| --- \| --- \|\n\| ([^|]+) \| figure \|', re.MULTILINE), r'### \1'),
+    )),
     # Fix bullet list formatting
-    markdown_text = re.sub(r'^- $', '', markdown_text, flags=re.MULTILINE)  # Remove empty bullets
-    markdown_text = re.sub(r'^- \n', '', markdown_text, flags=re.MULTILINE)  # Remove bullets with only newlines
-    
-    # Fix bullet list artifacts
-    markdown_text = re.sub(r'^- \)_', r'- ', markdown_text, flags=re.MULTILINE)  # Remove )_ artifacts
-    markdown_text = re.sub(r'^- \)_([^_]+)_', r'- \1', markdown_text, flags=re.MULTILINE)  # Fix )_text_ patterns
-    
+    ('- ', (
+        (re.compile(r'^- $', re.MULTILINE), ''),  # Remove empty bullets (and bullets with only newlines)
+        # Fix bullet list artifacts
+        (re.compile(r'^- \)_', re.MULTILINE), r'- '),  # Remove )_ artifacts
+        (re.compile(r'^- \)_([^_]+)_', re.MULTILINE), r'- \1'),  # Fix )_text_ patterns
+    )),
     # Fix spacing around headings
-    markdown_text = re.sub(r'([^\n])\n(#{1,6}\s)', r'\1\n\n\2', markdown_text)  # Add space before headings
-    markdown_text = re.sub(r'(#{1,6}\s+[^#\n]+)\n([^\n])', r'\1\n\n\2', markdown_text)  # Add space after headings
-    
+    ('#', (
+        (re.compile(r'([^\n])\n(#{1,6}\s)'), r'\1\n\n\2'),  # Add space before headings
+        (re.compile(r'(#{1,6}\s+[^#\n]+)\n([^\n])'), r'\1\n\n\2'),  # Add space after headings
+    )),
     # Fix italic formatting (convert * to _ for consistency)
-    markdown_text = re.sub(r'\*([^*]+)\*', r'_\1_', markdown_text)
-    
+    ('*', (
+        (re.compile(r'\*([^*]+)\*'), r'_\1_'),
+    )),
     # Fix em-dash spacing
-    markdown_text = re.sub(r'—([a-zA-Z])', r'— \1', markdown_text)
-    
-    # === RESTORE PROTECTED CONTENT ===
-    
-    # Restore links
-    def restore_link(match):
-        link_text = match.group(1)
-        link_url = match.group(2)
-        
-        # Handle cross-references if chapter_map provided
-        if chapter_map and '.xhtml#' in link_url:
-            if "#" in link_url:
-                file_part, anchor = link_url.split("#", 1)
-            else:
-                file_part, anchor = link_url, ""
-            if file_part in chapter_map:
-                md_target = chapter_map[file_part]
-                return f"[[{md_target}]]"
-        
-        return f"[{link_text}]({link_url})"
-    
-    markdown_text = re.sub(r'LINK_PLACEHOLDER_([^_]+)_([^_]+)', restore_link, markdown_text)
-    
-    # === FINAL CLEANUP ===
-    
+    ('—', (
+        (re.compile(r'—([a-zA-Z])'), r'— \1'),
+    )),
+)
+
+POST_PROCESS_FINAL_RULES = (
     # Remove any remaining artifacts
-    markdown_text = re.sub(r'^\s*:\s*$', '', markdown_text, flags=re.MULTILINE)  # Remove stray colons
-    
+    (':', (
+        (re.compile(r'^\s*:\s*$', re.MULTILINE), ''),  # Remove stray colons
+    )),
     # Remove placeholder artifacts
-    markdown_text = re.sub(r'LINK\)_PLACEHOLDER_', '', markdown_text)
-    
-    # Fix remaining artifacts
-    markdown_text = re.sub(r'\)\)_([^_]+)_', r'\1', markdown_text)  # Fix ))_text_ patterns
-    markdown_text = re.sub(r'\)_([^_]+)_', r'\1', markdown_text)  # Fix )_text_ patterns
-    
+    (')_', (
+        (re.compile(r'LINK\)_PLACEHOLDER_'), ''),
+        # Fix remaining artifacts
+        (re.compile(r'\)\)_([^_]+)_'), r'\1'),  # Fix ))_text_ patterns
+        (re.compile(r'\)_([^_]+)_'), r'\1'),  # Fix )_text_ patterns
+    )),
     # Fix academic book specific patterns
     # Fix malformed footnote links: [1](#fn21 → [1](#fn21)
-    markdown_text = re.sub(r'\[(\d+)\]\(#fn(\d+)$', r'[\1](#fn\2)', markdown_text, flags=re.MULTILINE)
-    
-    # Fix malformed figure links: [Figure 2.1](#fig21 → [Figure 2.1](#fig21)
-    markdown_text = re.sub(r'\[Figure ([^]]+)\]\(#fig([^)]+)$', r'[Figure \1](#fig\2)', markdown_text, flags=re.MULTILINE)
-    
-    # Fix malformed table links: [Table 2.2](#ch02-table2-2, → [Table 2.2](#ch02-table2-2)
-    markdown_text = re.sub(r'\[Table ([^]]+)\]\(#([^)]+),$', r'[Table \1](#\2)', markdown_text, flags=re.MULTILINE)
-    
-    # Fix trailing commas in any links: [text](#link, → [text](#link)
-    markdown_text = re.sub(r'\[([^\]]+)\]\(([^)]+),$', r'[\1](\2)', markdown_text, flags=re.MULTILINE)
-    
-    # Fix trailing commas in links followed by text: [text](#link, text → [text](#link) text
-    markdown_text = re.sub(r'\[([^\]]+)\]\(([^)]+),(\s)', r'[\1](\2)\3', markdown_text, flags=re.MULTILINE)
-    
-    # Fix malformed table links with underscores: Table 2.2_#ch02-table2-2 → [Table 2.2](#ch02-table2-2)
-    markdown_text = re.sub(r'([A-Za-z]+ \d+\.\d+)_#([^,\s]+)', r'[\1](#\2)', markdown_text)
-    
-    # Fix malformed table links with underscores at end: Table 2.4_#ch02-table2-4 → [Table 2.4](#ch02-table2-4)
-    markdown_text = re.sub(r'([A-Za-z]+ \d+\.\d+)_#([^,\s]+)', r'[\1](#\2)', markdown_text)
-    
+    ('](', (
+        (re.compile(r'\[(\d+)\]\(#fn(\d+)$', re.MULTILINE), r'[\1](#fn\2)'),
+        # Fix malformed figure links: [Figure 2.1](#fig21 → [Figure 2.1](#fig21)
+        (re.compile(r'\[Figure ([^]]+)\]\(#fig([^)]+)$', re.MULTILINE), r'[Figure \1](#fig\2)'),
+        # Fix malformed table links: [Table 2.2](#ch02-table2-2, → [Table 2.2](#ch02-table2-2)
+        (re.compile(r'\[Table ([^]]+)\]\(#([^)]+),$', re.MULTILINE), r'[Table \1](#\2)'),
+        # Fix trailing commas in any links: [text](#link, → [text](#link)
+        (re.compile(r'\[([^\]]+)\]\(([^)]+),$', re.MULTILINE), r'[\1](\2)'),
+        # Fix trailing commas in links followed by text: [text](#link, text → [text](#link) text
+        (re.compile(r'\[([^\]]+)\]\(([^)]+),(\s)', re.MULTILINE), r'[\1](\2)\3'),
+    )),
+    # Fix malformed table links with underscores (anywhere, including at the end of a line):
+    # Table 2.2_#ch02-table2-2 → [Table 2.2](#ch02-table2-2)
+    ('_#', (
+        (re.compile(r'([A-Za-z]+ \d+\.\d+)_#([^,\s]+)'), r'[\1](#\2)'),
+    )),
     # Remove internal anchor references since we're not doing web-style navigation
     # Pattern: [text](#anchor) → text
-    markdown_text = re.sub(r'\[([^\]]+)\]\(#([^)]+)\)', r'\1', markdown_text)
-    
+    ('](#', (
+        (re.compile(r'\[([^\]]+)\]\(#([^)]+)\)'), r'\1'),
+    )),
     # Fix orphaned parentheses from removed anchor references
     # Pattern: (Table X.Y → Table X.Y
-    markdown_text = re.sub(r'\(([A-Za-z]+ \d+\.\d+)', r'\1', markdown_text)
-    
+    ('(', (
+        (re.compile(r'\(([A-Za-z]+ \d+\.\d+)'), r'\1'),
+    )),
     # Fix trailing underscores in headings and text
-    markdown_text = re.sub(r'([^_])_$', r'\1', markdown_text, flags=re.MULTILINE)  # Remove trailing underscores
-    
-    # Fix double underscores in headings: ## __Introduction__ → ## Introduction
-    markdown_text = re.sub(r'^(#{1,6})\s*__([^_]+)__', r'\1 \2', markdown_text, flags=re.MULTILINE)
-    
+    ('_', (
+        (re.compile(r'([^_])_$', re.MULTILINE), r'\1'),  # Remove trailing underscores
+        # Fix double underscores in headings: ## __Introduction__ → ## Introduction
+        (re.compile(r'^(#{1,6})\s*__([^_]+)__', re.MULTILINE), r'\1 \2'),
+    )),
     # Fix complex academic book link patterns
     # Pattern: [Chapter 2 *](System structures)___04-9781315743332_contents.xhtml#chapter2
-    markdown_text = re.sub(r'\[([^]]+)\*\]\(([^)]+)___([^)]+)\)', r'[\1](\3)', markdown_text)
-    
+    ('*](', (
+        (re.compile(r'\[([^]]+)\*\]\(([^)]+)___([^)]+)\)'), r'[\1](\3)'),
+    )),
     # Fix incomplete image paths: ![fig2](images/fig → ![fig2](images/fig.jpg)
-    markdown_text = re.sub(r'!\[([^\]]+)\]\(([^)]*?images/[^)]*?)$', r'![\1](\2.jpg)', markdown_text, flags=re.MULTILINE)
-    
-    # Fix incomplete image paths with numbers: ![fig2](2.tifimages/fig → ![fig2](images/fig2.jpg)
-    markdown_text = re.sub(r'!\[([^\]]+)\]\((\d+)\.(tif|jpg|png)([^)]*?)([^)]*?)$', r'![\1](images/\5\2.\3)', markdown_text, flags=re.MULTILINE)
-    
-    # Fix duplicate file extensions in image paths (e.g., .jpg.jpg -> .jpg)
-    markdown_text = re.sub(r'!\[([^\]]+)\]\(([^)]*?)\.(jpg|png|gif|jpeg)\.(jpg|png|gif|jpeg)\)', r'![\1](\2.\3)', markdown_text)
-    
+    ('![', (
+        (re.compile(r'!\[([^\]]+)\]\(([^)]*?images/[^)]*?)$', re.MULTILINE), r'![\1](\2.jpg)'),
+        # Fix incomplete image paths with numbers: ![fig2](2.tifimages/fig → ![fig2](images/fig2.jpg)
+        (re.compile(r'!\[([^\]]+)\]\((\d+)\.(tif|jpg|png)([^)]*?)([^)]*?)$', re.MULTILINE), r'![\1](images/\5\2.\3)'),
+        # Fix duplicate file extensions in image paths (e.g., .jpg.jpg -> .jpg)
+        (re.compile(r'!\[([^\]]+)\]\(([^)]*?)\.(jpg|png|gif|jpeg)\.(jpg|png|gif|jpeg)\)'), r'![\1](\2.\3)'),
+    )),
     # Fix malformed images (missing opening bracket)
-    markdown_text = re.sub(r'!figure_images/([^_]+)', r'![figure](images/\1)', markdown_text)
-    markdown_text = re.sub(r'!figure\)_images/([^_]+)', r'![figure](images/\1)', markdown_text)
-    
+    ('!figure', (
+        (re.compile(r'!figure_images/([^_]+)'), r'![figure](images/\1)'),
+        (re.compile(r'!figure\)_images/([^_]+)'), r'![figure](images/\1)'),
+    )),
     # Fix broken image tags (missing closing parenthesis)
-    markdown_text = re.sub(r'!\[([^\]]+)\]\(([^)]+)$', r'![\1](\2)', markdown_text, flags=re.MULTILINE)
-    
+    ('![', (
+        (re.compile(r'!\[([^\]]+)\]\(([^)]+)$', re.MULTILINE), r'![\1](\2)'),
+    )),
     # Remove extra closing parentheses at the end
-    markdown_text = re.sub(r'\)+$', '', markdown_text)
-    
-    # Fix specific stray parentheses issues
-    markdown_text = re.sub(r'position\)$', 'position', markdown_text, flags=re.MULTILINE)  # Line 43
-    markdown_text = re.sub(r'experiencing\) perceiving', 'experiencing (perceiving', markdown_text)  # Line 45
-    markdown_text = re.sub(r'them\) explicitly', 'them (explicitly', markdown_text)  # Line 113
-    markdown_text = re.sub(r'^\s*\)\s*$', '', markdown_text, flags=re.MULTILINE)  # Standalone ) characters
-    
-    # Fix incomplete sentences with missing closing parentheses
-    markdown_text = re.sub(r'understanding the chair\?\n\)', 'understanding the chair?)', markdown_text)  # Line 45
-    markdown_text = re.sub(r'about the concept\.\n\)', 'about the concept.)', markdown_text)  # Line 114
-    
-    # Remove any remaining standalone ) characters that are clearly artifacts
-    markdown_text = re.sub(r'\n\)\n', '\n', markdown_text)  # Remove standalone ) on its own line
-    
-    # Fix the specific incomplete sentences by adding missing closing parentheses
-    markdown_text = re.sub(r'understanding the chair\?\n\)', 'understanding the chair?)', markdown_text)
-    markdown_text = re.sub(r'about the concept\.\n\)', 'about the concept.)', markdown_text)
-    
+    (')', (
+        (re.compile(r'\)+$'), ''),
+        # Fix specific stray parentheses issues (lines 43, 45 and 113), in one pass: the
+        # literals can't overlap and none of the fixes leaves a match for another
+        (STRAY_PARENTHESES_RE, lambda match: STRAY_PARENTHESES_FIXES[match.group()]),
+        (re.compile(r'^\s*\)\s*$', re.MULTILINE), ''),  # Standalone ) characters
+        # Fix incomplete sentences with missing closing parentheses (lines 45 and 114)
+        (re.compile(r'(understanding the chair\?|about the concept\.)\n\)'), r'\1)'),
+        # Remove any remaining standalone ) characters that are clearly artifacts
+        (re.compile(r'\n\)\n'), '\n'),  # Remove standalone ) on its own line
+    )),
+
     # === ENHANCED CLEANUP FOR OFFSITE ARCHITECTURE ISSUES ===
-    
     # Fix malformed image paths with file extension before folder path
     # Pattern: ![fig2](1.jpgimages/fig21.jpg) → ![fig2](images/fig2_1.jpg)
-    markdown_text = re.sub(r'!\[([^\]]+)\]\((\d+)\.(jpg|png|gif)([^)]*?images/[^)]*?)(\d+)\.(jpg|png|gif)\)', 
-                          r'![\1](images/fig\2_\5.\6)', markdown_text)
-    
-    # Fix image paths where underscores were removed
-    # Pattern: ![fig2](images/fig21.jpg) → ![fig2](images/fig2_1.jpg)
-    markdown_text = re.sub(r'!\[([^\]]+)\]\(images/fig(\d+)(\d+)\.(jpg|png|gif)\)', 
-                          r'![\1](images/fig\2_\3.\4)', markdown_text)
-    
-    # Fix more complex malformed image paths
-    # Pattern: ![fig2](1.jpgimages/fig21.jpg) → ![fig2](images/fig2_1.jpg)
-    markdown_text = re.sub(r'!\[([^\]]+)\]\((\d+)\.(jpg|png|gif|tif)([^)]*?)(\d+)\.(jpg|png|gif|tif)\)', 
-                          r'![\1](images/fig\2_\5.\6)', markdown_text)
-    
-    # Fix image paths with tif extension issues
-    # Pattern: ![fig2](2.tifimages/fig22.jpg) → ![fig2](images/fig2_2.jpg)
-    markdown_text = re.sub(r'!\[([^\]]+)\]\((\d+)\.(tif)([^)]*?)(\d+)\.(jpg|png|gif)\)', 
-                          r'![\1](images/fig\2_\5.\6)', markdown_text)
-    
+    ('![', (
+        (re.compile(r'!\[([^\]]+)\]\((\d+)\.(jpg|png|gif)([^)]*?images/[^)]*?)(\d+)\.(jpg|png|gif)\)'), r'![\1](images/fig\2_\5.\6)'),
+        # Fix image paths where underscores were removed
+        # Pattern: ![fig2](images/fig21.jpg) → ![fig2](images/fig2_1.jpg)
+        (re.compile(r'!\[([^\]]+)\]\(images/fig(\d+)(\d+)\.(jpg|png|gif)\)'), r'![\1](images/fig\2_\3.\4)'),
+        # Fix more complex malformed image paths
+        # Pattern: ![fig2](1.jpgimages/fig21.jpg) → ![fig2](images/fig2_1.jpg)
+        (re.compile(r'!\[([^\]]+)\]\((\d+)\.(jpg|png|gif|tif)([^)]*?)(\d+)\.(jpg|png|gif|tif)\)'), r'![\1](images/fig\2_\5.\6)'),
+        # Fix image paths with tif extension issues
+        # Pattern: ![fig2](2.tifimages/fig22.jpg) → ![fig2](images/fig2_2.jpg)
+        (re.compile(r'!\[([^\]]+)\]\((\d+)\.(tif)([^)]*?)(\d+)\.(jpg|png|gif)\)'), r'![\1](images/fig\2_\5.\6)'),
+    )),
     # Remove LINK_PLACEHOLDER_ artifacts from captions
     # Pattern: LINK_PLACEHOLDER_Figure 2.1 → Figure 2.1
-    markdown_text = re.sub(r'LINK_PLACEHOLDER_([^_\n]+)', r'\1', markdown_text)
-    
+    ('LINK_PLACEHOLDER_', (
+        (re.compile(r'LINK_PLACEHOLDER_([^_\n]+)'), r'\1'),
+    )),
     # Remove stray code from captions
     # Pattern: __System structural isomorphism (left) and equifinality (right)___04a-9781315743332_List_of_figures.xhtml#fig2_1
     # → System structural isomorphism (left) and equifinality (right)
-    markdown_text = re.sub(r'__([^_]+)___[^_\n]+', r'\1', markdown_text)
-    
+    ('___', (
+        (re.compile(r'__([^_]+)___[^_\n]+'), r'\1'),
+    )),
     # Fix forced line breaks caused by inline tags on their own lines
     # Pattern: word\n\n*italic*\n\nword → word *italic* word
-    markdown_text = re.sub(r'([a-zA-Z])\n\n\*([^*]+)\*\n\n([a-zA-Z])', r'\1 *\2* \3', markdown_text)
-    markdown_text = re.sub(r'([a-zA-Z])\n\n\*\*([^*]+)\*\*\n\n([a-zA-Z])', r'\1 **\2** \3', markdown_text)
-    
+    ('\n\n*', (
+        (re.compile(r'([a-zA-Z])\n\n\*([^*]+)\*\n\n([a-zA-Z])'), r'\1 *\2* \3'),
+    )),
+    # Kept separate from the italic fix: one pass over both would miss bold text whose
+    # leading letter was just used as the trailing letter of an italic match
+    ('\n\n**', (
+        (re.compile(r'([a-zA-Z])\n\n\*\*([^*]+)\*\*\n\n([a-zA-Z])'), r'\1 **\2** \3'),
+    )),
     # Fix stray parentheses that appear after text
     # Pattern: text) → text
-    markdown_text = re.sub(r'([a-zA-Z])\n\)', r'\1', markdown_text, flags=re.MULTILINE)
-    
+    ('\n)', (
+        (re.compile(r'([a-zA-Z])\n\)', re.MULTILINE), r'\1'),
+    )),
     # Remove leftover XHTML code artifacts
     # Pattern: any remaining HTML-like tags or attributes
-    markdown_text = re.sub(r'<[^>]+>', '', markdown_text)
-    markdown_text = re.sub(r'xmlns="[^"]*"', '', markdown_text)
-    markdown_text = re.sub(r'class="[^"]*"', '', markdown_text)
-    
+    ('<', (
+        (HTML_TAG_RE, ''),
+    )),
+    ('xmlns="', (
+        (re.compile(r'xmlns="[^"]*"'), ''),
+    )),
+    ('class="', (
+        (re.compile(r'class="[^"]*"'), ''),
+    )),
     # Fix escaped backslashes in image tags
     # Pattern: ![fig2\](images/fig1_1.jpg) → ![fig2](images/fig1_1.jpg)
-    markdown_text = re.sub(r'!\[([^\]]+)\\\]\(([^)]+)\)', r'![\1](\2)', markdown_text)
-    
+    ('\\](', (
+        (re.compile(r'!\[([^\]]+)\\\]\(([^)]+)\)'), r'![\1](\2)'),
+    )),
     # Fix broken caption formatting
     # Pattern: [Figure 2.1 → Figure 2.1
-    markdown_text = re.sub(r'\[Figure ([^\]\n]+)', r'Figure \1', markdown_text)
-    
-    # Fix broken caption formatting with trailing artifacts
-    # Pattern: [Figure 2.1\n](\System structural isomorphism... → Figure 2.1\n\nSystem structural isomorphism...
-    markdown_text = re.sub(r'\[Figure ([^\]\n]+)\n\]\([^)]+\)', r'Figure \1', markdown_text)
-    
+    ('[Figure ', (
+        (re.compile(r'\[Figure ([^\]\n]+)'), r'Figure \1'),
+        # Fix broken caption formatting with trailing artifacts
+        # Pattern: [Figure 2.1\n](\System structural isomorphism... → Figure 2.1\n\nSystem structural isomorphism...
+        (re.compile(r'\[Figure ([^\]\n]+)\n\]\([^)]+\)'), r'Figure \1'),
+    )),
     # Remove remaining link artifacts from captions
     # Pattern: ](\System structural isomorphism (left) and equifinality (right)\\__04a-9781315743332_List_of_figures.xhtml#fig2_1 → System structural isomorphism (left) and equifinality (right)
-    markdown_text = re.sub(r'\]\([^)]*?___[^)]*?\)', '', markdown_text)
-    
-    # Remove trailing artifacts after figure captions
-    # Pattern: ](System structural isomorphism (left) and equifinality (right)\__04a-9781315743332_List_of_figures.xhtml#fig2_1 → System structural isomorphism (left) and equifinality (right)
-    markdown_text = re.sub(r'\]\(([^)]*?)\__[^)]*?\)', r'\1', markdown_text)
-    
+    ('__', (
+        (re.compile(r'\]\([^)]*?___[^)]*?\)'), ''),
+        # Remove trailing artifacts after figure captions
+        # Pattern: ](System structural isomorphism (left) and equifinality (right)\__04a-9781315743332_List_of_figures.xhtml#fig2_1 → System structural isomorphism (left) and equifinality (right)
+        (re.compile(r'\]\(([^)]*?)\__[^)]*?\)'), r'\1'),
+    )),
     # Clean up any remaining escaped backslashes in text
-    markdown_text = re.sub(r'\\([^\\])', r'\1', markdown_text)
-    
+    ('\\', (
+        (re.compile(r'\\([^\\])'), r'\1'),
+    )),
+    # The rules below only see backslashes the pass above left behind (usually none), so
+    # each is probed again rather than sharing its group. They can't be merged into one
+    # alternation: that pass is what exposes \_\_ pairs from \\_\\_ in the first place.
     # Fix double underscores in headings and text
-    markdown_text = re.sub(r'\\_\\_([^_]+)\\\_\\_', r'\1', markdown_text)
-    
+    ('\\_\\_', (
+        (re.compile(r'\\_\\_([^_]+)\\\_\\_'), r'\1'),
+    )),
+
     # === CRITICAL FIXES FOR BOLD TEXT AND HEADINGS ===
-    
     # Fix escaped backslashes that should be bold text
     # Pattern: \text\ → **text**
-    markdown_text = re.sub(r'\\([^\\]+)\\', r'**\1**', markdown_text)
-    
-    # Fix missing headings that got merged with text
+    ('\\', (
+        (re.compile(r'\\([^\\]+)\\'), r'**\1**'),
+    )),
+    # Fix missing headings that got merged with text, one group per anchor phrase (a single
+    # alternation would stop at the nearest phrase and rewrite lines holding two differently)
     # Pattern: **Case study: the Cellophane House** some points from a case study → ## Case study: the Cellophane House\n\nsome points from a case study
-    markdown_text = re.sub(r'\*\*([^*]+)\*\*([^\n]+?)(In the following section)', r'## \1\n\n\3', markdown_text)
-    
+    ('In the following section', (
+        (re.compile(r'\*\*([^*]+)\*\*([^\n]+?)(In the following section)'), r'## \1\n\n\3'),
+    )),
     # Fix other missing headings
     # Pattern: **Integrated complexity** → ## Integrated complexity
-    markdown_text = re.sub(r'\*\*([^*]+)\*\*([^\n]+?)(Although it is perhaps)', r'## \1\n\n\3', markdown_text)
-    
+    ('Although it is perhaps', (
+        (re.compile(r'\*\*([^*]+)\*\*([^\n]+?)(Although it is perhaps)'), r'## \1\n\n\3'),
+    )),
     # Fix missing headings for parallel and serially nested deliveries
     # Pattern: **Parallel and serially nested deliveries** → ## Parallel and serially nested deliveries
-    markdown_text = re.sub(r'\*\*([^*]+)\*\*([^\n]+?)(In some cases)', r'## \1\n\n\3', markdown_text)
-    
+    ('In some cases', (
+        (re.compile(r'\*\*([^*]+)\*\*([^\n]+?)(In some cases)'), r'## \1\n\n\3'),
+    )),
     # Fix missing headings for case study
     # Pattern: **Case study: the Cellophane House** → ## Case study: the Cellophane House
-    markdown_text = re.sub(r'\*\*([^*]+)\*\*([^\n]+?)(One of the several)', r'## \1\n\n\3', markdown_text)
-    
+    ('One of the several', (
+        (re.compile(r'\*\*([^*]+)\*\*([^\n]+?)(One of the several)'), r'## \1\n\n\3'),
+    )),
     # Fix missing headings for key conclusions
     # Pattern: **Key conclusions and further research** → ## Key conclusions and further research
-    markdown_text = re.sub(r'\*\*([^*]+)\*\*([^\n]+?)(The notion)', r'## \1\n\n\3', markdown_text)
-    
+    ('The notion', (
+        (re.compile(r'\*\*([^*]+)\*\*([^\n]+?)(The notion)'), r'## \1\n\n\3'),
+    )),
     # Fix missing headings for notes
     # Pattern: **Notes** → ## Notes
-    markdown_text = re.sub(r'\*\*([^*]+)\*\*([^\n]+?)(1 taking)', r'## \1\n\n\3', markdown_text)
-    
+    ('1 taking', (
+        (re.compile(r'\*\*([^*]+)\*\*([^\n]+?)(1 taking)'), r'## \1\n\n\3'),
+    )),
     # Fix broken links (missing closing parenthesis)
-    markdown_text = re.sub(r'\[([^\]]+)\]\(([^)]+)$', r'[\1](\2)', markdown_text, flags=re.MULTILINE)
-    
+    ('](', (
+        (re.compile(r'\[([^\]]+)\]\(([^)]+)$', re.MULTILINE), r'[\1](\2)'),
+    )),
     # Fix malformed citations
-    markdown_text = re.sub(r'([A-Z][a-z]+, [A-Z]\. \([0-9]{4})([A-Z])', r'\1 \2', markdown_text)
-    
+    ('. (', (
+        (re.compile(r'([A-Z][a-z]+, [A-Z]\. \([0-9]{4})([A-Z])'), r'\1 \2'),
+    )),
     # Fix remaining artifacts at end of file
-    markdown_text = re.sub(r'\)\n\n# ([^#\n]+)\n\n\)', r')\n\n# \1', markdown_text)
-    markdown_text = re.sub(r'\)\n\n# ([^#\n]+)\n\n\)', r')\n\n# \1', markdown_text)
-    
+    (')\n\n# ', (
+        (re.compile(r'\)\n\n# ([^#\n]+)\n\n\)'), r')\n\n# \1'),
+    )),
     # Add line breaks after images for better formatting
-    markdown_text = re.sub(r'!\[([^\]]+)\]\(([^)]+)\)([^\n])', r'![\1](\2)\n\3', markdown_text)
+    ('![', (
+        (re.compile(r'!\[([^\]]+)\]\(([^)]+)\)([^\n])'), r'![\1](\2)\n\3'),
+    )),
+)
+
+def post_process_markdown(markdown_text: str, chapter_map=None, image_positions=None) -> str:
+    """
+    Phase 3: Post-process the Markdown for final polishing
+    """
+    
+    # === PROTECT IMPORTANT CONTENT ===
+    
+    # Protect links from modification (a template replacement, so no Python call per link)
+    markdown_text = MARKDOWN_LINK_RE.sub(r'LINK_PLACEHOLDER_\1_\2', markdown_text)
+    
+    # === CLEANUP AND FORMATTING ===
+    for probe, rules in POST_PROCESS_CLEANUP_RULES:
+        if probe in markdown_text:
+            for pattern, replacement in rules:
+                markdown_text = pattern.sub(replacement, markdown_text)
+    
+    # === RESTORE PROTECTED CONTENT ===
+    
+    # Restore links
+    def restore_link(match):
+        link_text = match.group(1)
+        link_url = match.group(2)
+        
+        # Handle cross-references if chapter_map provided
+        if chapter_map and '.xhtml#' in link_url:
+            if "#" in link_url:
+                file_part, anchor = link_url.split("#", 1)
+            else:
+                file_part, anchor = link_url, ""
+            if file_part in chapter_map:
+                md_target = chapter_map[file_part]
+                return f"[[{md_target}]]"
+        
+        return f"[{link_text}]({link_url})"
+    
+    if chapter_map:
+        markdown_text = LINK_PLACEHOLDER_RE.sub(restore_link, markdown_text)
+    else:
+        # Without a chapter_map every link is restored as-is
+        markdown_text = LINK_PLACEHOLDER_RE.sub(r'[\1](\2)', markdown_text)
+    
+    # === FINAL CLEANUP ===
+    for probe, rules in POST_PROCESS_FINAL_RULES:
+        if probe in markdown_text:
+            for pattern, replacement in rules:
+                markdown_text = pattern.sub(replacement, markdown_text)
     
     # === PHASE 4: HEADING-BASED IMAGE POSITIONING ===
     if image_positions:
-        # Find which images are already in the markdown
-        existing_images = set()
-        for match in re.finditer(r'!\[([^\]]+)\]\(([^)]+)\)', markdown_text):
-            alt, src = match.groups()
-            existing_images.add((alt, src))
+        # Find which images are already in the markdown, as (alt, src) pairs
+        existing_images = set(MARKDOWN_IMAGE_RE.findall(markdown_text))
         
-        # For missing images, find their associated heading and insert them there
+        # For missing images, find their associated heading and insert them there. The
+        # document is assembled once at the end: images go after their heading line
+        # (later ones first, as if each had been inserted straight after the heading)
+        # and the rest are appended.
+        insertions = {}
+        appended = []
+        heading_index = None  # (line end offset, lowercased heading line), built on first use
         for img_info in image_positions:
             if (img_info['alt'], img_info['src']) not in existing_images:
+                image_md = f"![{img_info['alt']}]({img_info['src']})"
                 heading = img_info['heading']
                 if heading:
-                    # Look for the heading in the markdown
-                    lines = markdown_text.split('\n')
-                    for i, line in enumerate(lines):
+                    # Look for the heading in the markdown, scanning heading lines only
+                    if heading_index is None:
+                        heading_index = [(match.end(), match.group().lower())
+                                         for match in HEADING_LINE_RE.finditer(markdown_text)]
+                    heading_lower = heading.lower()
+                    for line_end, line_lower in heading_index:
                         # Look for the heading (case-insensitive, partial match)
-                        if heading.lower() in line.lower() and line.strip().startswith('#'):
-                            # Insert image after this heading
-                            image_md = f"![{img_info['alt']}]({img_info['src']})"
-                            lines.insert(i + 1, image_md)
-                            lines.insert(i + 2, "")  # Add blank line after image
-                            markdown_text = '\n'.join(lines)
+                        if heading_lower in line_lower:
+                            # Insert image after this heading, followed by a blank line
+                            insertions.setdefault(line_end, []).append(image_md)
                             break
                     else:
                         # If heading not found, add to end
-                        markdown_text += f"\n\n![{img_info['alt']}]({img_info['src']})"
+                        appended.append(image_md)
                 else:
                     # No heading available, add to end
-                    markdown_text += f"\n\n![{img_info['alt']}]({img_info['src']})"
+                    appended.append(image_md)
+        
+        if insertions or appended:
+            parts = []
+            position = 0
+            for offset in sorted(insertions):
+                parts.append(markdown_text[position:offset])
+                parts.extend(f"\n{image_md}\n" for image_md in reversed(insertions[offset]))
+                position = offset
+            parts.append(markdown_text[position:])
+            parts.extend(f"\n\n{image_md}" for image_md in appended)
+            markdown_text = "".join(parts)
     
     # Final trim and ensure proper ending
     return markdown_text.strip() + '\n'
@@ -601,140 +681,357 @@ import argparse
 import subprocess
 from pathlib import Path
 from bs4 import BeautifulSoup
-from bs4.element import Tag
+from bs4.element import NavigableString
+from lxml import etree
 import zipfile
 import shutil
+import tempfile
+import mmap
 import json
+import socket
+import time
+import threading
+import http.client
+from datetime import datetime
+try:
+    import orjson  # Optional: faster JSON serialization for the conversion log
+except ImportError:
+    orjson = None
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 # Suppress XML parser warnings from BeautifulSoup
 from bs4 import XMLParsedAsHTMLWarning
 import warnings
 warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
 
 # === Constants ===
+PANDOC_BIN = "/opt/homebrew/bin/pandoc"  # Full path to Pandoc binary
 OUTPUT_ROOT = Path("/Users/stephenelms/Documents/Epub to Md")
 LOG_DIR = OUTPUT_ROOT / "logs"
-LOG_DIR.mkdir(parents=True, exist_ok=True)
 
 # === Functions ===
 
-def extract_epub(epub_path: Path, extract_to: Path):
-    """Unzips EPUB to a temporary folder."""
+def is_needed_epub_member(name: str) -> bool:
+    """Returns True for archive members the converter reads from disk (XHTML documents)."""
+    return name.endswith('.xhtml')
+
+def list_epub_members(zip_ref: zipfile.ZipFile, prefix: str = "") -> list:
+    """Returns the file members whose path starts with prefix, skipping absolute and '..' paths."""
+    return [
+        info for info in zip_ref.infolist()
+        if not info.is_dir()
+        and info.filename.startswith(prefix)
+        and not info.filename.startswith('/')
+        and '..' not in info.filename.split('/')
+    ]
+
+def copy_zip_member(zip_ref: zipfile.ZipFile, member: zipfile.ZipInfo, dest: Path, buffer: bytearray):
+    """Copies one archive member to dest through a caller-owned, reusable buffer."""
+    view = memoryview(buffer)
+    with zip_ref.open(member) as src, open(dest, 'wb') as dst:
+        while (size := src.readinto(buffer)):
+            dst.write(view[:size])
+
+def write_zip_members(zip_ref: zipfile.ZipFile, targets: list):
+    """Writes each (member, destination path) pair to disk through one reused buffer."""
+    for folder in {dest.parent for _, dest in targets}:
+        folder.mkdir(parents=True, exist_ok=True)
+    buffer = bytearray(1024 * 1024)
+    for info, dest in targets:
+        copy_zip_member(zip_ref, info, dest, buffer)
+
+def extract_epub(epub_path: Path, extract_to: Path, content_folder: str = ""):
+    """Extracts the XHTML files inside content_folder to extract_to and returns their archive names."""
+    extract_to = Path(extract_to)
+    prefix = f"{content_folder}/" if content_folder else ""
+    with zipfile.ZipFile(epub_path, 'r') as zip_ref:
+        members = [info for info in list_epub_members(zip_ref, prefix) if is_needed_epub_member(info.filename)]
+        write_zip_members(zip_ref, [(info, extract_to / info.filename) for info in members])
+    return [info.filename for info in members]
+
+def copy_epub_images(epub_path: Path, content_folder: str, images_dst: Path) -> bool:
+    """Copies <content_folder>/images/ (in any case) from the EPUB straight into images_dst.
+    Returns True if any image was copied.
+    """
+    prefix = f"{content_folder}/" if content_folder else ""
+    with zipfile.ZipFile(epub_path, 'r') as zip_ref:
+        targets = []
+        for info in list_epub_members(zip_ref, prefix):
+            relative = info.filename[len(prefix):]
+            if relative[:7].lower() == "images/" and len(relative) > 7:
+                targets.append((info, images_dst / relative[7:]))
+        write_zip_members(zip_ref, targets)
+    return bool(targets)
+
+def xhtml_names_in_folder(member_names: list, folder: str) -> set:
+    """Returns the names of the .xhtml archive members directly inside folder ("" for the archive root)."""
+    prefix = f"{folder}/" if folder else ""
+    return {
+        name[len(prefix):] for name in member_names
+        if name.startswith(prefix) and name.endswith('.xhtml') and '/' not in name[len(prefix):]
+    }
+
+def list_xhtml_files(folder: Path) -> set:
+    """Returns the names of the .xhtml files in a folder (scandir avoids a stat per entry)."""
+    with os.scandir(folder) as entries:
+        return {entry.name for entry in entries if entry.name.endswith('.xhtml')}
+
+# Shared recovering parser (matches BeautifulSoup's "xml" mode); lxml parsers can be
+# reused for any number of documents, as long as they aren't shared between threads
+XML_PARSER = etree.XMLParser(recover=True)
+
+def parse_xml_root(xml_source):
+    """Parses an XML/XHTML file (path or raw bytes) with lxml and returns its root element (or None)."""
+    try:
+        if isinstance(xml_source, bytes):
+            return etree.fromstring(xml_source, XML_PARSER)
+        with open(xml_source, 'rb') as f:
+            return etree.parse(f, XML_PARSER).getroot()
+    except etree.XMLSyntaxError:
+        return None  # Empty document
+
+def element_text(element) -> str:
+    """Equivalent of BeautifulSoup's get_text(strip=True) for an lxml element."""
+    return "".join(text.strip() for text in element.itertext())
+
+def find_element_with_class(root, tag: str, class_name: str):
+    """First <tag> (in any namespace) whose class attribute is exactly class_name, or None."""
+    return next((element for element in root.iter(f'{{*}}{tag}') if element.get('class') == class_name), None)
+
+def epub_type(element) -> str | None:
+    """Value of an element's epub:type attribute (resolved through its own "epub" prefix), or None."""
+    namespace = element.nsmap.get('epub')
+    return element.get(f'{{{namespace}}}type') if namespace else None
+
+# Heading tags (in any namespace) for iterdescendants()
+HEADING_TAGS = tuple(f'{{*}}h{level}' for level in range(1, 7))
+
+def find_opf_path(epub_path: Path) -> str:
+    """Reads container.xml from the EPUB archive and returns the OPF path (e.g. "OEBPS/content.opf")."""
     with zipfile.ZipFile(epub_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
-
-def find_opf_path(container_path: Path) -> Path:
-    """Parses container.xml to find the OPF file path."""
-    container_xml = Path(container_path) / "META-INF" / "container.xml"
-    with open(container_xml, 'r', encoding='utf-8') as f:
-        soup = BeautifulSoup(f, "xml")
-    rootfile = soup.find("rootfile")
+        root = parse_xml_root(zip_ref.read("META-INF/container.xml"))
+    rootfile = next(root.iter("{*}rootfile"), None) if root is not None else None
     # Extract the path to the OPF file from the container XML.
-    # Handle edge case where 'full-path' might be returned as a list.
-    if isinstance(rootfile, Tag) and rootfile.has_attr("full-path"):
-        full_path = rootfile["full-path"]
-        if isinstance(full_path, list):
-            full_path = full_path[0]
-        return Path(container_path) / full_path
+    if rootfile is not None and rootfile.get("full-path") is not None:
+        return rootfile.get("full-path")
     else:
         raise ValueError("Could not locate rootfile path in container.xml")
 
-def run_pandoc(input_file: Path, output_file: Path):
-    """Converts a single XHTML file to Markdown using Pandoc.
+# Marker paragraph placed between files when several XHTML files share one Pandoc run
+FILE_BREAK_MARKER = "EPUBTOMDFILEBREAK"
+FILE_BREAK_HTML = f"<p>{FILE_BREAK_MARKER}</p>".encode("utf-8")
+FILE_BREAK_RE = re.compile(rf'^{FILE_BREAK_MARKER}\n', flags=re.MULTILINE)
+
+def start_pandoc_server():
+    """Starts `pandoc server` on a free localhost port and returns (process, port), or None if unsupported."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    try:
+        process = subprocess.Popen(
+            [PANDOC_BIN, "server", "--port", str(port), "--timeout", "300"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return None
+
+    # Wait (up to 5 seconds) for the server to accept connections
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return None
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    stop_pandoc_server(process)
+    return None
+
+def stop_pandoc_server(process):
+    """Terminates a `pandoc server` process started by start_pandoc_server()."""
+    process.terminate()
+    process.wait()
+
+# Open `pandoc server` connections of the current thread (`connections`: port -> connection)
+PANDOC_SERVER_STATE = threading.local()
+
+def run_pandoc_server(xhtml: bytes, port: int) -> str | None:
+    """Converts XHTML to Markdown through a running `pandoc server`; returns None if the request fails."""
+    connections = getattr(PANDOC_SERVER_STATE, "connections", None)
+    if connections is None:
+        connections = PANDOC_SERVER_STATE.connections = {}
+    connection = connections.get(port)
+    if connection is None:
+        connection = connections[port] = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        body = json.dumps({"text": xhtml.decode("utf-8"), "from": "html", "to": "markdown", "wrap": "none"})
+        connection.request("POST", "/", body=body.encode("utf-8"), headers={
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        })
+        response = connection.getresponse()
+        result = json.loads(response.read())
+    except (OSError, ValueError, http.client.HTTPException):
+        # Drop the connection; a later request starts a fresh one
+        connection.close()
+        del connections[port]
+        return None
+
+    if response.status != 200 or not isinstance(result, dict) or result.get("base64") or "output" not in result:
+        return None
+    output = result["output"]
+    return output if output.endswith("\n") else output + "\n"  # Match the CLI's trailing newline
+
+def run_pandoc(xhtml: bytes, source: str = "<stdin>", server_port: int | None = None) -> str:
+    """Converts XHTML content to Markdown using Pandoc (the server if server_port is given, else the CLI).
 
     This function is responsible for structural conversion only.
     It does not perform post-processing cleanup (e.g., line merging, YAML injection).
     """
+    if server_port is not None:
+        md_content = run_pandoc_server(xhtml, server_port)
+        if md_content is not None:
+            return md_content
     try:
-        subprocess.run([
-            "/opt/homebrew/bin/pandoc",  # Full path to Pandoc binary
-            str(input_file),               # Input XHTML file
-            "-f", "html",                  # From format: HTML (XHTML compatible)
+        result = subprocess.run([
+            PANDOC_BIN,
+            "-f", "html",                  # From format: HTML (XHTML compatible), read from stdin
             "-t", "markdown",              # To format: Markdown
             "--wrap=none",                 # Prevent forced line breaks (natural wrapping)
-            "-o", str(output_file)         # Output Markdown file
-        ], check=True)
+        ], input=xhtml, check=True, stdout=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
-        print(f"Error: Pandoc failed for file {input_file}")
+        print(f"Error: Pandoc failed for file {source}")
         raise e
+    return result.stdout.decode("utf-8")
+
+def convert_xhtml_file(xhtml_file: str, content_root: Path, server_port: int | None = None) -> tuple:
+    """Converts one XHTML file with Pandoc and returns (filename, markdown)."""
+    xhtml_path = content_root / xhtml_file
+    return xhtml_file, run_pandoc(xhtml_path.read_bytes(), str(xhtml_path), server_port)
+
+def convert_xhtml_group(xhtml_files: list, content_root: Path, server_port: int | None = None) -> list:
+    """Converts a group of XHTML files with one Pandoc run and returns [(filename, markdown), ...].
+    Falls back to one run per file if the combined output can't be split cleanly.
+    """
+    if len(xhtml_files) == 1:
+        return [convert_xhtml_file(xhtml_files[0], content_root, server_port)]
+
+    combined_xhtml = (b"\n\n" + FILE_BREAK_HTML + b"\n\n").join(
+        (content_root / xhtml_file).read_bytes() for xhtml_file in xhtml_files
+    )
+    combined_md = run_pandoc(combined_xhtml, ", ".join(xhtml_files), server_port)
+
+    parts = FILE_BREAK_RE.split(combined_md)
+    if len(parts) != len(xhtml_files) or "[^" in combined_md:
+        return [convert_xhtml_file(xhtml_file, content_root, server_port) for xhtml_file in xhtml_files]
+    return [(xhtml_file, part.strip("\n") + "\n") for xhtml_file, part in zip(xhtml_files, parts)]
+
+def clean_chapter_file(md_content: str, chapter_map: dict, md_path: Path, yaml_header: str | None = None) -> Path:
+    """Runs both cleanup passes on one chapter's Markdown and writes it to md_path, after yaml_header if given.
+    Kept at module level so it can be pickled and run in a ProcessPoolExecutor worker.
+    """
+    cleaned_md = clean_markdown_text(md_content, chapter_map=None)
+    # chapter_map only rewrites [text](file.xhtml#anchor) links; without any, skip the lookups
+    if '.xhtml#' not in cleaned_md:
+        chapter_map = None
+    cleaned_md = clean_markdown_text(cleaned_md, chapter_map=chapter_map)
+    with open(md_path, "w", encoding="utf-8", buffering=1 << 20) as f:
+        # Written piece by piece rather than concatenated, so the chapter isn't copied again
+        if yaml_header is not None:
+            f.write(yaml_header)
+            f.write("\n\n")
+        f.write(cleaned_md)
+    return md_path
 
 def parse_toc_xhtml(toc_path: Path):
     """Parses toc.xhtml and returns a list of (filename, anchor, label, depth) in TOC order."""
-    from bs4 import BeautifulSoup
-    from bs4.element import Tag
-    with open(toc_path, 'r', encoding='utf-8') as f:
-        soup = BeautifulSoup(f, 'xml')  # Use strict XML parsing
+    root = parse_xml_root(toc_path)
 
     toc_entries = []
 
     def process_ol(ol_tag, depth=1):
-        for li in ol_tag.find_all('li', recursive=False):
-            a_tag = li.find('a', href=True)
-            if a_tag and isinstance(a_tag, Tag):
-                href = a_tag.get('href', '')
-                if isinstance(href, list):
-                    href = href[0] if href else ''
-                label = a_tag.get_text(strip=True)
+        for li in ol_tag.iterfind('{*}li'):
+            a_tag = next((a for a in li.iter('{*}a') if a.get('href') is not None), None)
+            if a_tag is not None:
+                href = a_tag.get('href')
+                label = element_text(a_tag)
                 if href and '.xhtml' in href:
                     if '#' in href:
                         file_part, anchor = href.split('#', 1)
                     else:
                         file_part, anchor = href, None
                     toc_entries.append((file_part, anchor, label, depth))
-            nested_ol = li.find('ol', recursive=False)
-            if nested_ol and isinstance(nested_ol, Tag):
+            nested_ol = li.find('{*}ol')
+            if nested_ol is not None:
                 process_ol(nested_ol, depth + 1)
 
-    nav = soup.find('nav')
-    if nav and isinstance(nav, Tag):
-        ol = nav.find('ol')
-        if ol and isinstance(ol, Tag):
+    if root is None:
+        return toc_entries
+
+    nav = next(root.iter('{*}nav'), None)
+    if nav is not None:
+        ol = next(nav.iter('{*}ol'), None)
+        if ol is not None:
             process_ol(ol)
     else:
         # fallback to flat structure
-        for a in soup.find_all('a', href=True):
-            if isinstance(a, Tag):
-                href = a.get('href', '')
-                if isinstance(href, list):
-                    href = href[0] if href else ''
-                label = a.get_text(strip=True)
-                if href and '.xhtml' in href:
-                    if '#' in href:
-                        file_part, anchor = href.split('#', 1)
-                    else:
-                        file_part, anchor = href, None
-                    toc_entries.append((file_part, anchor, label, 1))
+        for a in root.iter('{*}a'):
+            href = a.get('href')
+            if href is None:
+                continue
+            label = element_text(a)
+            if href and '.xhtml' in href:
+                if '#' in href:
+                    file_part, anchor = href.split('#', 1)
+                else:
+                    file_part, anchor = href, None
+                toc_entries.append((file_part, anchor, label, 1))
     return toc_entries
 
+EDITED_BY_RE = re.compile(r'^EDITED BY\s+', re.IGNORECASE)  # Prefix on fulltitle author lines
+
 def extract_book_metadata_from_copyright(content_root: Path) -> dict | None:
     """Extract book metadata from copyright statement using RNIB_COPYRIGHT_LEGALESE IDs or fulltitle page."""
     # First try RNIB_COPYRIGHT_LEGALESE format
     for xhtml_file in content_root.glob("*.xhtml"):
         try:
-            with open(xhtml_file, 'r', encoding='utf-8') as f:
-                soup = BeautifulSoup(f, 'xml')
+            xhtml_bytes = xhtml_file.read_bytes()
+            # Only the copyright page carries these ids; skip parsing every other file
+            if b'RNIB_COPYRIGHT_LEGALESE_' not in xhtml_bytes:
+                continue
+            root = parse_xml_root(xhtml_bytes)
+            if root is None:
+                continue
             
             metadata = {}
             
+            # First <p> for each id, in one walk over the paragraphs
+            paragraphs_by_id = {}
+            for paragraph in root.iter('{*}p'):
+                paragraphs_by_id.setdefault(paragraph.get('id'), paragraph)
+            
             # Look for the copyright title element
-            copyright_title = soup.find('p', id='RNIB_COPYRIGHT_LEGALESE_0')
-            if copyright_title:
-                title = copyright_title.get_text(strip=True)
+            copyright_title = paragraphs_by_id.get('RNIB_COPYRIGHT_LEGALESE_0')
+            if copyright_title is not None:
+                title = element_text(copyright_title)
                 if title and title != "":
                     metadata['title'] = title
                     print(f"[INFO] Found book title from copyright: {title}")
             
             # Look for the copyright authors element
-            copyright_authors = soup.find('p', id='RNIB_COPYRIGHT_LEGALESE_1')
-            if copyright_authors:
-                authors = copyright_authors.get_text(strip=True)
+            copyright_authors = paragraphs_by_id.get('RNIB_COPYRIGHT_LEGALESE_1')
+            if copyright_authors is not None:
+                authors = element_text(copyright_authors)
                 if authors and authors != "":
                     metadata['authors'] = authors
                     print(f"[INFO] Found book authors from copyright: {authors}")
             
             # Look for the copyright ISBN element
-            copyright_isbn = soup.find('p', id='RNIB_COPYRIGHT_LEGALESE_2')
-            if copyright_isbn:
-                isbn = copyright_isbn.get_text(strip=True)
+            copyright_isbn = paragraphs_by_id.get('RNIB_COPYRIGHT_LEGALESE_2')
+            if copyright_isbn is not None:
+                isbn = element_text(copyright_isbn)
                 if isbn and isbn != "":
                     metadata['isbn'] = isbn
                     print(f"[INFO] Found book ISBN from copyright: {isbn}")
@@ -749,35 +1046,36 @@ def extract_book_metadata_from_copyright(content_root: Path) -> dict | None:
     # Fallback: Look for title and authors in fulltitle page
     for xhtml_file in content_root.glob("*fulltitle*.xhtml"):
         try:
-            with open(xhtml_file, 'r', encoding='utf-8') as f:
-                soup = BeautifulSoup(f, 'xml')
+            root = parse_xml_root(xhtml_file)
+            if root is None:
+                continue
             
             metadata = {}
             
             # Look for book title
-            book_title = soup.find('h1', class_='book-title')
-            if book_title:
-                title = book_title.get_text(strip=True)
+            book_title = find_element_with_class(root, 'h1', 'book-title')
+            if book_title is not None:
+                title = element_text(book_title)
                 if title and title != "":
                     metadata['title'] = title
                     print(f"[INFO] Found book title from fulltitle: {title}")
             
             # Look for subtitle
-            subtitle = soup.find('p', class_='subtitle1')
-            if subtitle:
-                subtitle_text = subtitle.get_text(strip=True)
+            subtitle = find_element_with_class(root, 'p', 'subtitle1')
+            if subtitle is not None:
+                subtitle_text = element_text(subtitle)
                 if subtitle_text and subtitle_text != "":
                     if 'title' in metadata:
                         metadata['title'] = metadata['title'] + " – " + subtitle_text
                     print(f"[INFO] Found book subtitle: {subtitle_text}")
             
             # Look for authors
-            author1 = soup.find('p', class_='author1')
-            if author1:
-                authors = author1.get_text(strip=True)
+            author1 = find_element_with_class(root, 'p', 'author1')
+            if author1 is not None:
+                authors = element_text(author1)
                 if authors and authors != "":
                     # Remove "EDITED BY" prefix
-                    authors = re.sub(r'^EDITED BY\s+', '', authors, flags=re.IGNORECASE)
+                    authors = EDITED_BY_RE.sub('', authors)
                     metadata['authors'] = authors
                     print(f"[INFO] Found book authors from fulltitle: {authors}")
             
@@ -796,6 +1094,60 @@ def extract_book_title_from_copyright(content_root: Path) -> str | None:
     metadata = extract_book_metadata_from_copyright(content_root)
     return metadata.get('title') if metadata else None
 
+# === BIBTEX PARSING ===
+BIBTEX_KEY_RE = re.compile(r'\{([^,]+),')  # Citation key on an entry's first line: "BOOK{Smith2017-zx,"
+BIBTEX_ASSIGNMENT_LINE_RE = re.compile(r'^.*=.*$', re.MULTILINE)  # Field lines; wrapped abstracts rarely have '='
+TITLE_WORD_RE = re.compile(r'\w+')  # Words compared when fuzzy-matching titles (maximal \w runs, as \b\w+\b)
+# A field line is read as the first of these names it contains
+BIBTEX_FIELD_RES = (
+    ('title', re.compile(r'title\s*=\s*["\']([^"\']+)["\']')),
+    ('author', re.compile(r'author\s*=\s*["\']([^"\']+)["\']')),
+    ('editor', re.compile(r'editor\s*=\s*["\']([^"\']+)["\']')),
+    ('year', re.compile(r'year\s*=\s*["\']?(\d{4})["\']?')),
+    ('publisher', re.compile(r'publisher\s*=\s*["\']([^"\']+)["\']')),
+)
+
+def parse_bibtex_entries(bibtex_content: str) -> list:
+    """Parse BibTeX text into entry dicts holding the citation key and the fields used for matching."""
+    entries = []
+    
+    # Split into individual entries
+    for entry in bibtex_content.split('@'):
+        if not entry.strip():
+            continue
+        
+        key_match = BIBTEX_KEY_RE.search(entry.split('\n', 1)[0].strip())
+        if not key_match:
+            continue
+        
+        fields = {name: None for name, _ in BIBTEX_FIELD_RES}
+        for line_match in BIBTEX_ASSIGNMENT_LINE_RE.finditer(entry):
+            line = line_match.group().strip()
+            for name, pattern in BIBTEX_FIELD_RES:
+                if name in line:
+                    value_match = pattern.search(line)
+                    if value_match:
+                        value = value_match.group(1)
+                        fields[name] = value if name == 'year' else clean_bibtex_text(value)
+                    break
+        
+        entries.append({'citation_key': key_match.group(1).strip(), **fields})
+    
+    return entries
+
+@lru_cache(maxsize=4)
+def load_bibtex_entries(path_str: str, mtime_ns: int, size: int) -> list:
+    """Parses a BibTeX file into entries, cached per path, modification time and size.
+    The returned dicts are shared between calls and must not be modified.
+    """
+    with open(path_str, 'r', encoding='utf-8') as f:
+        entries = parse_bibtex_entries(f.read())
+    for entry in entries:
+        if entry['title']:
+            entry['title_lower'] = entry['title'].lower()
+            entry['title_words'] = set(TITLE_WORD_RE.findall(entry['title_lower']))
+    return entries
+
 def find_bibtex_entry_by_title_and_authors(title: str, authors: str, bibtex_path: Path = Path("epub.bib")) -> dict | None:
     """Find BibTeX entry by matching title and authors with robust parsing."""
     if not bibtex_path.exists():
@@ -803,69 +1155,20 @@ def find_bibtex_entry_by_title_and_authors(title: str, authors: str, bibtex_path
         return None
     
     try:
-        with open(bibtex_path, 'r', encoding='utf-8') as f:
-            bibtex_content = f.read()
+        bibtex_stat = bibtex_path.stat()
+        entries = load_bibtex_entries(str(bibtex_path), bibtex_stat.st_mtime_ns, bibtex_stat.st_size)
         
-        # Split into individual entries
-        entries = bibtex_content.split('@')
+        # The search title is the same for every entry; tokenize it once
+        title_lower = title.lower()
+        title_words = set(TITLE_WORD_RE.findall(title_lower))
         
         for entry in entries:
-            if not entry.strip():
-                continue
-            
-            # Extract entry type and key
-            lines = entry.split('\n')
-            if not lines:
-                continue
-            
-            first_line = lines[0].strip()
-            
-            # Extract citation key - look for pattern like "BOOK{Smith2017-zx,"
-            key_match = re.search(r'\{([^,]+),', first_line)
-            if not key_match:
-                continue
-            
-            citation_key = key_match.group(1).strip()
-            
-            # Look for title and author/editor fields with better parsing
-            entry_title = None
-            entry_authors = None
-            entry_editor = None
-            entry_year = None
-            entry_publisher = None
-            
-            for line in lines:
-                line = line.strip()
-                
-                # Extract title with better regex
-                if 'title' in line and '=' in line:
-                    title_match = re.search(r'title\s*=\s*["\']([^"\']+)["\']', line)
-                    if title_match:
-                        entry_title = clean_bibtex_text(title_match.group(1))
-                
-                # Extract author with fallback to editor
-                elif 'author' in line and '=' in line:
-                    author_match = re.search(r'author\s*=\s*["\']([^"\']+)["\']', line)
-                    if author_match:
-                        entry_authors = clean_bibtex_text(author_match.group(1))
-                
-                # Extract editor as fallback
-                elif 'editor' in line and '=' in line:
-                    editor_match = re.search(r'editor\s*=\s*["\']([^"\']+)["\']', line)
-                    if editor_match:
-                        entry_editor = clean_bibtex_text(editor_match.group(1))
-                
-                # Extract year for additional matching
-                elif 'year' in line and '=' in line:
-                    year_match = re.search(r'year\s*=\s*["\']?(\d{4})["\']?', line)
-                    if year_match:
-                        entry_year = year_match.group(1)
-                
-                # Extract publisher for additional context
-                elif 'publisher' in line and '=' in line:
-                    publisher_match = re.search(r'publisher\s*=\s*["\']([^"\']+)["\']', line)
-                    if publisher_match:
-                        entry_publisher = clean_bibtex_text(publisher_match.group(1))
+            citation_key = entry['citation_key']
+            entry_title = entry['title']
+            entry_authors = entry['author']
+            entry_editor = entry['editor']
+            entry_year = entry['year']
+            entry_publisher = entry['publisher']
             
             # Use editor as fallback if no author found
             if not entry_authors and entry_editor:
@@ -874,16 +1177,22 @@ def find_bibtex_entry_by_title_and_authors(title: str, authors: str, bibtex_path
             
             # Try to match title and authors
             if entry_title and entry_authors:
+                entry_title_lower = entry['title_lower']
+                
+                # Also check if the search title is contained in the entry title
+                title_contained = title_lower in entry_title_lower
+                
+                # Cheap filter: every shared word is also a substring of the entry title, so
+                # if at most half the words are substrings the overlap can't exceed 0.5
+                if not title_contained and sum(word in entry_title_lower for word in title_words) <= len(title_words) / 2:
+                    continue
+                
                 # Enhanced fuzzy matching
-                title_words = set(re.findall(r'\b\w+\b', title.lower()))
-                entry_title_words = set(re.findall(r'\b\w+\b', entry_title.lower()))
+                entry_title_words = entry['title_words']
                 
                 # Check for significant overlap in title words
                 title_overlap = len(title_words & entry_title_words) / max(len(title_words), 1)
                 
-                # Also check if the search title is contained in the entry title
-                title_contained = title.lower() in entry_title.lower()
-                
                 # Additional check: if titles are very similar (high overlap)
                 if title_overlap > 0.5 or title_contained:
                     return {
@@ -902,15 +1211,20 @@ def find_bibtex_entry_by_title_and_authors(title: str, authors: str, bibtex_path
         print(f"[ERROR] Error parsing BibTeX file: {e}")
         return None
 
+BRACE_CONTENT_RE = re.compile(r"\{(.*?)\}")  # `{...}` groups; the content is kept
+AUTHOR_SEPARATOR_RE = re.compile(r'\s+and\s+')
+BIBTEX_TEXT_TRANSLATION = str.maketrans({"\n": " ", "&": "and"})
+
 def clean_bibtex_text(text: str) -> str:
     """Clean BibTeX text by removing braces and normalizing formatting."""
     if not text:
         return ""
     
     text = text.strip()
-    text = text.replace("\n", " ")  # Ensure multiline text is on a single line
-    text = re.sub(r"\{(.*?)\}", r"\1", text)  # Remove braces `{}` while preserving content
-    text = text.replace("&", "and")  # Replace ampersands with "and"
+    # Ensure multiline text is on a single line and replace ampersands with "and", in one
+    # pass; the newlines have to go before the brace pattern, which doesn't span lines
+    text = text.translate(BIBTEX_TEXT_TRANSLATION)
+    text = BRACE_CONTENT_RE.sub(r"\1", text)  # Remove braces `{}` while preserving content
     return text.strip()
 
 def parse_bibtex_authors(author_string: str) -> list:
@@ -926,12 +1240,12 @@ def parse_bibtex_authors(author_string: str) -> list:
         author_string = author_string[3:].strip()
     
     # Identify institutions inside `{}` and preserve them
-    protected_authors = re.findall(r"\{.*?\}", author_string)  # Find `{}` enclosed text
+    protected_authors = [match.group() for match in BRACE_CONTENT_RE.finditer(author_string)]  # Find `{}` enclosed text
     temp_replacement = "INSTITUTION_PLACEHOLDER"
-    temp_authors = re.sub(r"\{.*?\}", temp_replacement, author_string)  # Temporarily replace institutions
+    temp_authors = BRACE_CONTENT_RE.sub(temp_replacement, author_string)  # Temporarily replace institutions
     
     # Split by " and " to separate individual authors
-    authors = re.split(r'\s+and\s+', temp_authors)
+    authors = AUTHOR_SEPARATOR_RE.split(temp_authors)
     
     # If we only got one author but it contains a comma, it might be two authors
     if len(authors) == 1 and ',' in authors[0]:
@@ -1014,14 +1328,62 @@ def generate_yaml_header(title: str, chapter: str, authors: list, citation_key:
     
     return "\n".join(yaml_lines)
 
-def extract_title_from_xhtml(xhtml_path: Path) -> str:
-    """Extracts the <title> from an XHTML file and converts to Title Case."""
-    with open(xhtml_path, 'r', encoding='utf-8') as f:
-        soup = BeautifulSoup(f, 'xml')  # Use strict XML parsing
-    title_tag = soup.find('title')
-    raw_title = title_tag.get_text(strip=True) if title_tag else "Untitled"
+# Plain-text <title> near the top of a file (markup inside it falls back to a full parse)
+TITLE_TAG_RE = re.compile(rb'<title(?:\s[^>]*)?>([^<]*)</title>')
+XML_REFERENCE_RE = re.compile(r'&(?:(amp|lt|gt|quot|apos)|#([0-9]+)|#x([0-9a-fA-F]+));')
+XML_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+DIGITS_RE = re.compile(r'\d+')  # First number in a section id or id part
+CHAPTER_NUMBER_RE = re.compile(r'CHAPTER\s+(\d+)')
+LEVEL_ID_RE = re.compile(r'level\d+_')  # Subsection ids (level1_000001, ...), used with match()
+
+def unescape_xml_text(text: str) -> str | None:
+    """Resolves XML's predefined entities and character references in text; returns None for any other entity."""
+    if '&' not in text:
+        return text
+    if '&' in XML_REFERENCE_RE.sub('', text):
+        return None
+
+    def resolve(match):
+        name, decimal, hexadecimal = match.groups()
+        if name:
+            return XML_ENTITIES[name]
+        codepoint = int(decimal, 10) if decimal else int(hexadecimal, 16)
+        # Only characters allowed in XML 1.0 documents
+        if not (codepoint in (0x9, 0xA, 0xD) or 0x20 <= codepoint <= 0xD7FF
+                or 0xE000 <= codepoint <= 0xFFFD or 0x10000 <= codepoint <= 0x10FFFF):
+            raise ValueError(f"Invalid XML character reference: {match.group()}")
+        return chr(codepoint)
+
+    try:
+        return XML_REFERENCE_RE.sub(resolve, text)
+    except ValueError:
+        return None
+
+def title_from_xhtml_bytes(data) -> str:
+    """Extracts the <title> from raw XHTML bytes (or a memory-mapped file) and converts to Title Case."""
+    match = TITLE_TAG_RE.search(data, 0, 4096)
+    if match:
+        try:
+            title = unescape_xml_text(match.group(1).decode('utf-8'))
+        except UnicodeDecodeError:
+            title = None  # Not UTF-8, let the XML parser handle the declared encoding
+        if title is not None:
+            return title_case(title.strip())
+
+    root = parse_xml_root(bytes(data))
+    title_tag = next(root.iter('{*}title'), None) if root is not None else None
+    raw_title = element_text(title_tag) if title_tag is not None else "Untitled"
     return title_case(raw_title)
 
+@lru_cache(maxsize=None)
+def extract_title_from_xhtml(xhtml_path: Path) -> str:
+    """Extracts the <title> from an XHTML file (memoized per path) and converts to Title Case."""
+    with open(xhtml_path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:  # mmap can't map an empty file
+            return title_from_xhtml_bytes(b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return title_from_xhtml_bytes(mapped)
+
 def extract_xhtml_metadata(xhtml_path: Path) -> dict:
     """
     Extract comprehensive metadata from XHTML file including:
@@ -1033,8 +1395,8 @@ def extract_xhtml_metadata(xhtml_path: Path) -> dict:
     ENHANCED: Now searches for IDs on ANY tag within the body, not just section/div tags.
     This fixes the subsection detection issue where level IDs are placed on h1, h2, p tags, etc.
     """
-    with open(xhtml_path, 'r', encoding='utf-8') as f:
-        soup = BeautifulSoup(f, 'xml')
+    xhtml_bytes = xhtml_path.read_bytes()  # Read once for both the title and the tree
+    root = parse_xml_root(xhtml_bytes)
     
     metadata = {
         'title': "Untitled",
@@ -1050,25 +1412,21 @@ def extract_xhtml_metadata(xhtml_path: Path) -> dict:
         'all_ids': []  # NEW: Track all IDs in the file
     }
     
-    # Extract title
-    title_tag = soup.find('title')
-    if title_tag:
-        raw_title = title_tag.get_text(strip=True)
-        metadata['title'] = title_case(raw_title)
+    # Extract title (usually matched without a full parse)
+    metadata['title'] = title_from_xhtml_bytes(xhtml_bytes)
     
     # Extract body type from body tag
-    body_tag = soup.find('body')
-    if body_tag and isinstance(body_tag, Tag):
-        metadata['body_type'] = body_tag.get('epub:type')
+    body_tag = next(root.iter('{*}body'), None) if root is not None else None
+    if body_tag is not None:
+        metadata['body_type'] = epub_type(body_tag)
     
     # --- ENHANCED SECTION ID DETECTION ---
     # Find ALL tags in the body that have ID attributes, not just the first one
     # This is crucial for detecting subsections that are anchors within the same file
-    if body_tag and isinstance(body_tag, Tag):
-        all_id_tags = body_tag.find_all(id=True)
-        for tag in all_id_tags:
-            if isinstance(tag, Tag) and tag.get('id'):
-                metadata['all_ids'].append(tag.get('id'))
+    id_tags = []
+    if body_tag is not None:
+        id_tags = [tag for tag in body_tag.iterdescendants(etree.Element) if tag.get('id')]
+        metadata['all_ids'] = [tag.get('id') for tag in id_tags]
     
     # Use the first ID for primary classification (usually the main section/chapter ID)
     if metadata['all_ids']:
@@ -1076,11 +1434,7 @@ def extract_xhtml_metadata(xhtml_path: Path) -> dict:
         metadata['section_id'] = primary_id
         
         # Get the type from the first tag with an ID
-        first_id_tag = None
-        if body_tag and isinstance(body_tag, Tag):
-            first_id_tag = body_tag.find(id=primary_id)
-        if first_id_tag and isinstance(first_id_tag, Tag):
-            metadata['section_type'] = first_id_tag.get('epub:type')
+        metadata['section_type'] = epub_type(id_tags[0])
     # --- END ENHANCED SECTION ---
     
     # Determine content type based on metadata
@@ -1112,28 +1466,28 @@ def extract_xhtml_metadata(xhtml_path: Path) -> dict:
         # Extract chapter number from various formats using regex for better reliability
         if section_id.startswith("ch"):
             try:
-                match = re.search(r'\d+', section_id)
+                match = DIGITS_RE.search(section_id)
                 if match:
                     metadata['chapter_number'] = int(match.group())
             except (ValueError, AttributeError):
                 pass
         elif section_id.startswith("chapter"):
             try:
-                match = re.search(r'\d+', section_id)
+                match = DIGITS_RE.search(section_id)
                 if match:
                     metadata['chapter_number'] = int(match.group())
             except (ValueError, AttributeError):
                 pass
         elif section_id.startswith("Sec"):
             try:
-                match = re.search(r'\d+', section_id)
+                match = DIGITS_RE.search(section_id)
                 if match:
                     metadata['chapter_number'] = int(match.group())
             except (ValueError, AttributeError):
                 pass
         # Extract from title if section_id doesn't have number
         elif "CHAPTER" in title_upper:
-            match = re.search(r'CHAPTER\s+(\d+)', title_upper)
+            match = CHAPTER_NUMBER_RE.search(title_upper)
             if match:
                 try:
                     metadata['chapter_number'] = int(match.group(1))
@@ -1153,7 +1507,7 @@ def extract_xhtml_metadata(xhtml_path: Path) -> dict:
                     if len(parts) >= 2:
                         try:
                             # Use regex to find number in case of extra chars
-                            match = re.search(r'\d+', parts[1])
+                            match = DIGITS_RE.search(parts[1])
                             if match:
                                 metadata['subsection_number'] = int(match.group())
                         except (ValueError, AttributeError):
@@ -1176,96 +1530,87 @@ def extract_subsections_from_xhtml(xhtml_path: Path) -> list:
     Returns a list of subsection metadata for files that contain multiple subsections.
     This handles the case where subsections are anchors within the same XHTML file as the chapter.
     """
-    with open(xhtml_path, 'r', encoding='utf-8') as f:
-        soup = BeautifulSoup(f, 'xml')
+    root = parse_xml_root(xhtml_path)
     
     subsections = []
-    body_tag = soup.find('body')
+    body_tag = next(root.iter('{*}body'), None) if root is not None else None
     
-    if not body_tag or not isinstance(body_tag, Tag):
+    if body_tag is None:
         return subsections
     
     # Find all tags with level IDs (level1_000001, level2_000002, etc.)
-    level_tags = body_tag.find_all(id=True)
     level_tags = []
-    for tag in body_tag.find_all(id=True):
-        if isinstance(tag, Tag):
-            tag_id = tag.get('id')
-            if tag_id and isinstance(tag_id, str) and re.match(r'^level\d+_', tag_id):
-                level_tags.append(tag)
+    for tag in body_tag.iterdescendants(etree.Element):
+        tag_id = tag.get('id')
+        if tag_id and LEVEL_ID_RE.match(tag_id):
+            level_tags.append(tag)
     
     for tag in level_tags:
-        if isinstance(tag, Tag):
-            section_id = tag.get('id', '')
-            if not section_id or not isinstance(section_id, str):
-                continue
-            
-            # Parse level and subsection number
-            parts = section_id.split('_')
-            if len(parts) >= 2:
-                level_part = parts[0]
-                if level_part.startswith('level'):
-                    try:
-                        level = int(level_part[5:])
-                        # Extract subsection number
-                        match = re.search(r'\d+', parts[1])
-                        subsection_num = int(match.group()) if match else 0
-                        
-                        # Extract title from the tag content
-                        title = tag.get_text(strip=True)
-                        if not title:
-                            # Try to find a heading within this tag
-                            heading = tag.find(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
-                            if heading and isinstance(heading, Tag):
-                                title = heading.get_text(strip=True)
-                        
-                        if title:
-                            subsections.append({
-                                'section_id': section_id,
-                                'level': level,
-                                'subsection_number': subsection_num,
-                                'title': title_case(title),
-                                'tag_name': tag.name
-                            })
-                    except (ValueError, AttributeError):
-                        continue
+        section_id = tag.get('id')
+        
+        # Parse level and subsection number
+        parts = section_id.split('_')
+        if len(parts) >= 2:
+            level_part = parts[0]
+            if level_part.startswith('level'):
+                try:
+                    level = int(level_part[5:])
+                    # Extract subsection number
+                    match = DIGITS_RE.search(parts[1])
+                    subsection_num = int(match.group()) if match else 0
+                    
+                    # Extract title from the tag content
+                    title = element_text(tag)
+                    if not title:
+                        # Try to find a heading within this tag
+                        heading = next(tag.iterdescendants(*HEADING_TAGS), None)
+                        if heading is not None:
+                            title = element_text(heading)
+                    
+                    if title:
+                        subsections.append({
+                            'section_id': section_id,
+                            'level': level,
+                            'subsection_number': subsection_num,
+                            'title': title_case(title),
+                            'tag_name': etree.QName(tag).localname
+                        })
+                except ValueError:
+                    continue
     
     # Sort subsections by level and subsection number
     subsections.sort(key=lambda x: (x['level'], x['subsection_number']))
     return subsections
 
+# Primary patterns for chapter detection, tried as one alternation anchored at the start
+CHAPTER_BOUNDARY_PATTERNS = (
+    r'^CHAPTER\s+\d+',           # "CHAPTER 1", "CHAPTER 2"
+    r'^SECTION\s+\d+',           # "SECTION 1", "SECTION 2" 
+    r'^PART\s+\d+',              # "PART 1", "PART 2"
+    r'^\d+\.\s+[A-Z]',           # "1. INTRODUCTION", "2. METHODS"
+    r'^[A-Z][A-Z\s]{10,}$',      # Long all-caps titles (likely chapters)
+    r'^INTRODUCTION$',            # Common chapter title
+    r'^CONCLUSION$',              # Common chapter title
+    r'^\d+\s*[-–]\s*[A-Z]',      # "1 - TITLE" format
+    r'^APPENDIX\s*[A-Z]?$',      # "APPENDIX A", "APPENDIX"
+    r'^BIBLIOGRAPHY$',           # Common back matter
+    r'^REFERENCES$',              # Common back matter
+    r'^GLOSSARY$',                # Common back matter
+    r'^INDEX$',                   # Common back matter
+)
+CHAPTER_BOUNDARY_RE = re.compile("|".join(f"(?:{pattern})" for pattern in CHAPTER_BOUNDARY_PATTERNS))
+
 def is_chapter_boundary(title: str, label: str) -> bool:
     """
     Determine if a TOC entry represents a new chapter boundary.
     Returns True if this should start a new chapter group.
     """
-    import re
     title_upper = title.upper()
     label_upper = label.upper()
     
-    # Primary patterns for chapter detection
-    chapter_patterns = [
-        r'^CHAPTER\s+\d+',           # "CHAPTER 1", "CHAPTER 2"
-        r'^SECTION\s+\d+',           # "SECTION 1", "SECTION 2" 
-        r'^PART\s+\d+',              # "PART 1", "PART 2"
-        r'^\d+\.\s+[A-Z]',           # "1. INTRODUCTION", "2. METHODS"
-        r'^[A-Z][A-Z\s]{10,}$',      # Long all-caps titles (likely chapters)
-        r'^INTRODUCTION$',            # Common chapter title
-        r'^CONCLUSION$',              # Common chapter title
-        r'^\d+\s*[-–]\s*[A-Z]',      # "1 - TITLE" format
-        r'^APPENDIX\s*[A-Z]?$',      # "APPENDIX A", "APPENDIX"
-        r'^BIBLIOGRAPHY$',           # Common back matter
-        r'^REFERENCES$',              # Common back matter
-        r'^GLOSSARY$',                # Common back matter
-        r'^INDEX$'                    # Common back matter
-    ]
-    
     # Check title patterns
-    for pattern in chapter_patterns:
-        if re.match(pattern, title_upper):
-            return True
-        if re.match(pattern, label_upper):
-            return True
+    if CHAPTER_BOUNDARY_RE.match(title_upper) or CHAPTER_BOUNDARY_RE.match(label_upper):
+        return True
     
     # Additional heuristics
     if len(title_upper) > 50 and title_upper.isupper():
@@ -1299,6 +1644,15 @@ def validate_chapter_groups(chapter_groups, max_expected_chapters=20):
     
     return True
 
+# Back matter keywords, matched against lowercased titles and file names
+BACK_MATTER_KEYWORDS = ("references", "glossary", "index")
+BACK_MATTER_TITLE_RE = re.compile("|".join(BACK_MATTER_KEYWORDS))
+# File names like "references.xhtml" or "12_index.xhtml": the whole stem is the keyword,
+# so names such as "index_split_001.xhtml" are left to the title check
+BACK_MATTER_FILENAME_RE = re.compile(rf"(?:\d+[_-]?)?(?:{'|'.join(BACK_MATTER_KEYWORDS)})")
+# Titles that end a chapter group in the TOC-driven structure
+TOC_BACK_MATTER_TITLE_RE = re.compile("|".join(BACK_MATTER_KEYWORDS + ("conclusion", "discussion")))
+
 def build_toc_driven_structure(toc_entries, content_root: Path) -> tuple:
     """
     Build chapter structure based on TOC hierarchy first, then validate with metadata.
@@ -1312,6 +1666,8 @@ def build_toc_driven_structure(toc_entries, content_root: Path) -> tuple:
     # Extract metadata for all files for validation
     file_metadata = {}
     for file, _, _, _ in toc_entries:
+        if file in file_metadata:
+            continue  # Same file listed again with a different anchor
         xhtml_path = content_root / file
         if xhtml_path.exists():
             file_metadata[file] = extract_xhtml_metadata(xhtml_path)
@@ -1367,7 +1723,7 @@ def build_toc_driven_structure(toc_entries, content_root: Path) -> tuple:
             continue
         
         # Check if this is back matter
-        if any(keyword in title.lower() for keyword in ["references", "glossary", "index", "conclusion", "discussion"]):
+        if TOC_BACK_MATTER_TITLE_RE.search(title.lower()):
             # Save current chapter if exists
             if current_chapter is not None and current_chapter_files:
                 chapter_groups.append((current_chapter, current_chapter_title, current_chapter_files))
@@ -1414,6 +1770,25 @@ def build_toc_driven_structure(toc_entries, content_root: Path) -> tuple:
     
     return chapter_groups, frontmatter_files, backmatter_files
 
+def group_toc_entries(toc_entries, titles: dict, content_root: Path) -> tuple:
+    """Sets aside back matter (by file name or title), then groups the rest with build_toc_driven_structure().
+
+    Returns (chapter_groups, front_matter, back_matter), with the files set aside here first in back_matter.
+    """
+    main_entries = []
+    detected_back_matter = []
+    for entry in toc_entries:
+        file = entry[0]
+        # File names are checked first; the title only decides when the file name gives no hint
+        if BACK_MATTER_FILENAME_RE.fullmatch(Path(file).stem.lower()) or BACK_MATTER_TITLE_RE.search(titles[file].lower()):
+            detected_back_matter.append(file)
+        else:
+            main_entries.append(entry)
+    chapter_groups, front_matter, back_matter = build_toc_driven_structure(main_entries, content_root)
+    # build_toc_driven_structure() never sees the files set aside above, so add them back
+    back_matter = list(dict.fromkeys(detected_back_matter + back_matter))
+    return chapter_groups, front_matter, back_matter
+
 # === CLI ===
 
 def generate_obsidian_toc(conversion_log, output_dir: Path, book_title: str = None):
@@ -1466,13 +1841,9 @@ def generate_obsidian_toc(conversion_log, output_dir: Path, book_title: str = No
     return toc_filename
 
 def show_final_dialog(log: dict, elapsed_sec: float, md_status=True, cleanup_status=True, json_status=True):
-    """Displays a summary dialog on macOS using AppleScript."""
-    import subprocess
-    from pathlib import Path
-
+    """Displays a summary dialog on macOS using AppleScript, without waiting for it to close."""
     def icon(flag): return "✅" if flag else "❌"
 
-    from pathlib import Path
     md_files = list(Path(log.get("output_dir", ".")).glob("*.md"))
     count = len(md_files)
     time_min = int(elapsed_sec // 60)
@@ -1498,10 +1869,14 @@ def show_final_dialog(log: dict, elapsed_sec: float, md_status=True, cleanup_sta
 🕒 Time elapsed: {time_str}
 """
 
-    subprocess.run([
+    # Also on stderr, so non-interactive runs see the summary without a dialog
+    print(summary, file=sys.stderr)
+
+    # Fire and forget: don't block the caller until the user clicks OK
+    subprocess.Popen([
         "osascript", "-e",
         f'display dialog "{summary}" buttons ["OK"] default button "OK" with title "EPUB to Markdown Converter Summary"'
-    ])
+    ], close_fds=True)
 
 def test_single_xhtml(xhtml_path: Path, output_dir: Path | None = None):
     """Test function to convert a single XHTML file to Markdown using the new three-phase approach."""
@@ -1510,8 +1885,9 @@ def test_single_xhtml(xhtml_path: Path, output_dir: Path | None = None):
     
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    # Extract title for filename
-    title = extract_title_from_xhtml(xhtml_path)
+    # Read the original XHTML once; the title (for the filename) comes from the same bytes
+    xhtml_bytes = xhtml_path.read_bytes()
+    title = title_from_xhtml_bytes(xhtml_bytes)
     safe_title = safe_filename(title)
     output_filename = f"test_{safe_title}.md"
     output_path = output_dir / output_filename
@@ -1520,9 +1896,7 @@ def test_single_xhtml(xhtml_path: Path, output_dir: Path | None = None):
     print(f"Title: {title}")
     print(f"Output: {output_path}")
     
-    # Read the original XHTML content
-    with open(xhtml_path, "r", encoding="utf-8") as f:
-        xhtml_content = f.read()
+    xhtml_content = xhtml_bytes.decode("utf-8")
     
     print(f"\n=== ORIGINAL XHTML CONTENT (first 500 chars) ===")
     print(xhtml_content[:500] + "..." if len(xhtml_content) > 500 else xhtml_content)
@@ -1541,7 +1915,6 @@ def test_single_xhtml(xhtml_path: Path, output_dir: Path | None = None):
     return output_path
 
 def main():
-    import re
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="Convert EPUB to Markdown (Obsidian-ready)")
     parser.add_argument("epub_file", type=Path, nargs="?", help="Path to the .epub file")
@@ -1595,16 +1968,10 @@ def main():
             print(f"File not found: {input_path}")
             sys.exit(1)
 
-        from tempfile import NamedTemporaryFile
-        with NamedTemporaryFile(suffix=".md", delete=False) as tmp:
-            tmp_path = Path(tmp.name)
-            run_pandoc(input_path, tmp_path)
-            with open(tmp_path, "r", encoding="utf-8") as f:
-                raw_md = f.read()
-                md_content = clean_markdown_text(raw_md, None)
-            print("=== Cleaned Markdown Output ===\n")
-            print(md_content)
-            tmp_path.unlink()
+        raw_md = run_pandoc(input_path.read_bytes(), str(input_path))
+        md_content = clean_markdown_text(raw_md, None)
+        print("=== Cleaned Markdown Output ===\n")
+        print(md_content)
         return
 
     epub_file = args.epub_file.resolve()  # Resolve full path to EPUB
@@ -1612,13 +1979,18 @@ def main():
         print(f"File not found: {epub_file}")
         sys.exit(1)
 
+    # Extract into a context-managed temp folder (honours TMPDIR) that is removed
+    # once the conversion finishes, even if it fails part-way
+    with tempfile.TemporaryDirectory(prefix=f"epub_extract_{epub_file.stem}_") as temp_dir:
+        return convert_epub(epub_file, Path(temp_dir))
+
+def convert_epub(epub_file: Path, temp_dir: Path) -> dict:
+    """Runs the full EPUB to Markdown conversion, using temp_dir as the extraction folder."""
     epub_abs_path = str(epub_file.resolve())
     SCRIPT_VERSION = "v0.9.0-beta"
 
-    from datetime import datetime
     start_timestamp = datetime.utcnow().isoformat() + "Z"
 
-    images_src = None  # will be set before use
     # Initialize conversion_log without output_dir (will be updated later)
     conversion_log = {
         "epub": epub_file.name,
@@ -1635,18 +2007,15 @@ def main():
         "chapters": []
     }
 
-    temp_dir = Path("/tmp") / f"epub_extract_{epub_file.stem}"  # Temporary extraction folder
-    if temp_dir.exists():
-        shutil.rmtree(temp_dir)
-    temp_dir.mkdir(parents=True)
-
     # === PHASE 1: Pandoc Conversion Phase ===
-    # Extract EPUB contents into temporary folder for processing
-    extract_epub(epub_file, temp_dir)
+    # Locate the OPF file via container.xml (read from the archive), then extract
+    # only the OPF's folder into the temporary folder for processing
+    opf_name = find_opf_path(epub_file)
+    extracted_names = extract_epub(epub_file, temp_dir, content_folder=opf_name.rpartition('/')[0])
     print(f"EPUB extracted to: {temp_dir}")
 
-    opf_path = find_opf_path(temp_dir)  # Locate OPF file via container.xml
-    content_root = opf_path.parent      # Set root for content folder (usually OEBPS or EPUB)
+    opf_path = temp_dir / opf_name
+    content_root = opf_path.parent      # Set root for content folder (usually OEBPS or EPUB; the OPF itself isn't extracted)
     
     # Handle different EPUB folder structures
     # Some EPUBs have XHTML files directly in OEBPS/, others in OEBPS/html/
@@ -1659,7 +2028,7 @@ def main():
     # Find the folder that contains XHTML files
     actual_content_root = None
     for root in potential_content_roots:
-        if root.exists() and any(root.glob("*.xhtml")):
+        if root.is_dir() and list_xhtml_files(root):
             actual_content_root = root
             break
     
@@ -1689,14 +2058,16 @@ def main():
     conversion_log["output_dir"] = str(output_dir)
     conversion_log["book_title"] = book_title if book_title else epub_file.stem
 
-    # Copy images directory if present
-    images_src = content_root / "images"
+    # Copy images directory if present (straight from the archive)
     images_dst = output_dir / "images"
-    if images_src.exists() and images_src.is_dir():
-        shutil.copytree(images_src, images_dst, dirs_exist_ok=True)
+    content_folder = content_root.relative_to(temp_dir).as_posix()
+    if content_folder == ".":
+        content_folder = ""
+    images_copied = copy_epub_images(epub_file, content_folder, images_dst)
+    if images_copied:
         print(f"Copied images to: {images_dst}")
     # Update images_moved status in conversion_log
-    conversion_log["images_moved"] = images_src.exists() and images_src.is_dir() and any(images_src.iterdir())
+    conversion_log["images_moved"] = images_copied
 
     # Parse the Table of Contents (toc.xhtml) to obtain ordered chapter files
     toc_file = content_root / "toc.xhtml"  # Look for the navigation file
@@ -1710,8 +2081,8 @@ def main():
         for f, a, l, d in toc_entries
     ]
 
-    # List all xhtml files in content_root
-    all_xhtml_files = {f.name for f in (content_root).glob("*.xhtml")}
+    # List all xhtml files in content_root (from the extracted archive names, not the disk)
+    all_xhtml_files = xhtml_names_in_folder(extracted_names, content_folder)
     
     # --- FIX: Explicitly remove toc.xhtml so it is not processed as content ---
     # This prevents the duplicate TOC file issue where toc.xhtml gets converted to Markdown
@@ -1721,34 +2092,26 @@ def main():
     # --- END FIX ---
     
     conversion_log["xhtml_files_in_epub"] = sorted(list(all_xhtml_files))
-    toc_xhtml_files = [file for file, _, _, _ in toc_entries]
-    toc_used = set(toc_xhtml_files)
+    # TOC files in reading order, each listed once (anchor-only entries repeat the same file)
+    toc_used = dict.fromkeys(file for file, _, _, _ in toc_entries)
+
+    # Look up each TOC file's title once; the back-matter scan and file naming below
+    # read from this dict (unlinked files are never named, so their titles aren't needed)
+    titles = {file: extract_title_from_xhtml(content_root / file) for file in toc_used}
 
     # Front matter: files not referenced in TOC (will be overridden by metadata-driven structure)
-    old_front_matter = sorted(all_xhtml_files - toc_used)
+    old_front_matter = sorted(all_xhtml_files - toc_used.keys())
     conversion_log["unlinked_files"] = sorted(list(old_front_matter))
 
-    # --- Automatic back matter detection based on title keywords ---
-    back_keywords = ["references", "glossary", "index"]
     # Remove toc.xhtml from TOC-driven structure (already handled separately as front matter)
     toc_main_entries = [(f, a, l, d) for f, a, l, d in toc_entries if "toc.xhtml" not in f]
-    back_matter = []
-    filtered_toc_main_entries = []
-    for file, anchor, label, depth in toc_main_entries:
-        xhtml_path = content_root / file
-        title = extract_title_from_xhtml(xhtml_path).lower()
-        if any(keyword in title for keyword in back_keywords):
-            back_matter.append(file)
-        else:
-            filtered_toc_main_entries.append((file, anchor, label, depth))
-    toc_main_entries = filtered_toc_main_entries
-    # --------------------------------------------------------------
 
     # === CHAPTER GROUPING (TOC-DRIVEN) ===
     # Use TOC hierarchy as primary source of truth, validate with metadata
     # This prevents over-extraction of subsections that are just anchors within chapters
+    # Back matter is detected automatically from file names and title keywords
     print("\n=== BUILDING TOC-DRIVEN STRUCTURE ===")
-    chapter_groups, front_matter, back_matter = build_toc_driven_structure(toc_main_entries, content_root)
+    chapter_groups, front_matter, back_matter = group_toc_entries(toc_main_entries, titles, content_root)
     
     # Debug output for TOC-driven structure
     print("\n=== TOC-DRIVEN STRUCTURE RESULTS ===")
@@ -1799,18 +2162,16 @@ def main():
 
     # --- Front Matter ---
     # Files not referenced in TOC are considered front matter and labeled as 00a, 00b, ...
-    # Sort frontmatter files by their order in the TOC to ensure sequential lettering
-    frontmatter_with_order = []
-    for i, (file, anchor, label, depth) in enumerate(toc_entries):
-        if file in front_matter:
-            frontmatter_with_order.append((i, file))  # (toc_index, filename)
-    
-    # Sort by TOC order and assign sequential letters
-    frontmatter_with_order.sort(key=lambda x: x[0])
-    for i, (toc_index, fname) in enumerate(frontmatter_with_order):
-        label = f"00{chr(ord('a') + i)}"
-        chapter_index_map[fname] = label
-        file_sections.append((label, [fname], "Front Matter"))
+    # Walking toc_entries in order already yields TOC order, so letters are assigned
+    # in the same pass that classifies each entry.
+    front_matter_set = set(front_matter)
+    front_matter_count = 0
+    for file, anchor, label, depth in toc_entries:
+        if file in front_matter_set:
+            label = f"00{chr(ord('a') + front_matter_count)}"
+            front_matter_count += 1
+            chapter_index_map[file] = label
+            file_sections.append((label, [file], "Front Matter"))
 
     # --- Chapters + Subsections ---
     # Each chapter group: first file is the chapter header (e.g., 01.0), subsequent files are subsections (e.g., 01.1, 01.2, ...)
@@ -1835,11 +2196,36 @@ def main():
     for k, v in chapter_index_map.items():
         print(f"{k}: {v}")
 
+    # --- FILE NAMING ---
+    # Assign logical filenames (00a, 01a, etc.) based on TOC and extracted titles.
+    # Output names depend only on label and title, so the full chapter_map is known
+    # before Pandoc runs; the converted Markdown then goes straight to cleanup in Phase 3.
+    chapter_map = {}  # XHTML file -> final .md filename
+    for label, group, chap_title in file_sections:
+        if not group:
+            continue
+        for fname in group:
+            # A file can be listed more than once (e.g. several TOC anchors); name it once
+            if fname in chapter_map:
+                warning = f"Expected markdown not found: {Path(fname).stem}.md"
+                print(f"Warning: {warning}")
+                conversion_log["warnings"].append(warning)
+                continue
+            title = titles[fname]
+            safe_title = safe_filename(title)
+            output_filename = f"{label} - {safe_title}.md"
+            chapter_map[fname] = output_filename
+            # Log for JSON
+            conversion_log["chapters"].append({
+                "index": label,
+                "title": title,
+                "source_files": [fname],
+                "output_file": output_filename
+            })
+            print(f"[INFO] Named {Path(fname).stem}.md as {output_filename}")
+
     # --- PHASE 1: Pandoc Conversion Phase ---
-    # Convert all .xhtml files to temp .md files in a dedicated temp_md_dir
-    temp_md_dir = temp_dir / "md"
-    temp_md_dir.mkdir(parents=True, exist_ok=True)
-    
+    # Convert all .xhtml files to Markdown held in memory (read from Pandoc's stdout)
     # Get all files that need to be converted (including subsections)
     all_files_to_convert = set()
     all_files_to_convert.update(all_xhtml_files)  # All XHTML files
@@ -1865,78 +2251,35 @@ def main():
             print(f"Warning: {warning}")
             conversion_log["warnings"].append(warning)
     
-    for xhtml_file in xhtml_files_for_md:
-        xhtml_path = content_root / xhtml_file
-        md_temp_path = temp_md_dir / f"{Path(xhtml_file).stem}.md"
-        run_pandoc(xhtml_path, md_temp_path)
-    print(f"[Phase 1] Converted {len(xhtml_files_for_md)} XHTML files to Markdown in temp folder: {temp_md_dir}")
-
-    # --- PHASE 2: File Naming & Renaming Phase ---
-    # Assign logical filenames (00a, 01a, etc.) based on TOC and extracted titles.
-    # Move .md files from temp_md_dir to final output directory.
-    chapter_map = {}  # XHTML file -> final .md filename
-    for label, group, chap_title in file_sections:
-        if not group:
-            continue
-        for fname in group:
-            xhtml_path = content_root / fname
-            title = extract_title_from_xhtml(xhtml_path)
-            safe_title = safe_filename(title)
-            output_filename = f"{label} - {safe_title}.md"
-            stem = Path(fname).stem
-            md_temp_path = temp_md_dir / (Path(fname).stem + ".md")
-            output_path = output_dir / output_filename
-            # Check if the expected file exists before moving
-            if not md_temp_path.exists():
-                warning = f"Expected markdown not found: {md_temp_path.name}"
-                print(f"Warning: {warning}")
-                conversion_log["warnings"].append(warning)
-                continue
-            # Move/rename the file
-            shutil.move(str(md_temp_path), str(output_path))
-            chapter_map[fname] = output_filename
-            # Log for JSON
-            conversion_log["chapters"].append({
-                "index": label,
-                "title": title,
-                "source_files": [fname],
-                "output_file": output_filename
-            })
-            print(f"[Phase 2] Moved {md_temp_path.name} to {output_filename}")
-
-    # Remove any leftover temp .md files (should be none, but for safety)
-    for f in temp_md_dir.glob("*.md"):
-        f.unlink()
-    # Only remove temp_md_dir if it is empty
-    if not any(temp_md_dir.iterdir()):
-        temp_md_dir.rmdir()
-    print(f"[Phase 2] Temp Markdown files cleaned up.")
-
-    # --- PHASE 3: Markdown Cleanup Phase ---
-    # Read each .md file in the output directory, apply clean_markdown_text() (excluding link conversion)
-    for entry in conversion_log["chapters"]:
-        md_path = output_dir / entry["output_file"]
-        if not md_path.exists():
-            continue
-        with open(md_path, "r", encoding="utf-8") as f:
-            raw_md = f.read()
-        cleaned_md = clean_markdown_text(raw_md, chapter_map=None)  # Exclude link conversion
-        with open(md_path, "w", encoding="utf-8") as f:
-            f.write(cleaned_md)
-        print(f"[Phase 3] Cleaned markdown: {entry['output_file']}")
-
-    # --- PHASE 4: Cross-Link Rewriting Phase ---
-    # Replace internal [text](chapter.xhtml#anchor) with Obsidian [[filename#anchor]]
-    for entry in conversion_log["chapters"]:
-        md_path = output_dir / entry["output_file"]
-        if not md_path.exists():
-            continue
-        with open(md_path, "r", encoding="utf-8") as f:
-            raw_md = f.read()
-        cleaned_md = clean_markdown_text(raw_md, chapter_map=chapter_map)
-        with open(md_path, "w", encoding="utf-8") as f:
-            f.write(cleaned_md)
-        print(f"[Phase 4] Rewrote cross-links in: {entry['output_file']}")
+    # Batch the Pandoc calls: the files are split, in reading order (chapters first, then
+    # front matter, back matter and unlinked files), into one batch per worker so each
+    # worker pays the Pandoc start-up cost once rather than once per file.
+    max_workers = os.cpu_count() or 1
+    ordered_files = list(dict.fromkeys(
+        [f for _, _, files in chapter_groups for f in files] + xhtml_files_for_md
+    ))
+    batch_size = max(1, -(-len(ordered_files) // max_workers))  # Ceiling division
+    pandoc_batches = [ordered_files[i:i + batch_size] for i in range(0, len(ordered_files), batch_size)]
+
+    # Use a long-running `pandoc server` when this Pandoc supports it (CLI otherwise)
+    pandoc_server = start_pandoc_server()
+    server_port = pandoc_server[1] if pandoc_server else None
+    print(f"[INFO] Pandoc mode: {'server on port ' + str(server_port) if pandoc_server else 'CLI'}")
+
+    # The batches are independent, so fan them out across all cores as well. The work
+    # happens in the Pandoc processes (or server), and waiting on a subprocess or socket
+    # releases the GIL, so threads are enough and no Python worker processes are started.
+    converted = {}  # XHTML file -> markdown
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch_results in executor.map(
+                convert_xhtml_group, pandoc_batches, repeat(content_root), repeat(server_port)
+            ):
+                converted.update(batch_results)
+    finally:
+        if pandoc_server:
+            stop_pandoc_server(pandoc_server[0])
+    print(f"[Phase 1] Converted {len(xhtml_files_for_md)} XHTML files to Markdown in {len(pandoc_batches)} Pandoc runs ({max_workers} workers)")
 
     # Generate Obsidian-compatible Table of Contents file
     # This creates the main TOC file with proper Obsidian links
@@ -1946,7 +2289,11 @@ def main():
     print(f"[INFO] Generated Obsidian-compatible TOC: {toc_path}")
 
     # --- PHASE 5: YAML Header Injection Phase ---
-    # Extract book metadata and generate YAML headers
+    # Extract book metadata and generate YAML headers. Headers depend only on the book
+    # metadata and the output/TOC filenames, so they are built up front and written
+    # together with each chapter's cleaned Markdown in Phase 3 (no read-back/rewrite).
+    chapter_entries = conversion_log["chapters"]
+    yaml_headers = [None] * len(chapter_entries)
     book_metadata = extract_book_metadata_from_copyright(content_root)
     
     if book_metadata:
@@ -1961,45 +2308,46 @@ def main():
             bibtex_authors = parse_bibtex_authors(bibtex_entry['authors'])
             
             # Generate YAML headers for all chapters
-            for entry in conversion_log["chapters"]:
-                md_path = output_dir / entry["output_file"]
-                if not md_path.exists():
-                    continue
-                
-                # Read current content
-                with open(md_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                
-                # Generate YAML header using the full title from BibTeX entry
-                yaml_header = generate_yaml_header(
+            yaml_headers = [
+                generate_yaml_header(
                     title=bibtex_entry['title'],  # Use full title from BibTeX
                     chapter=entry["output_file"],
                     authors=bibtex_authors,
                     citation_key=citation_key,
                     toc_filename=toc_filename
                 )
-                
-                # Prepend YAML header to content
-                new_content = yaml_header + "\n\n" + content
-                
-                # Write back to file
-                with open(md_path, "w", encoding="utf-8") as f:
-                    f.write(new_content)
-                
-                print(f"[Phase 5] Added YAML header to: {entry['output_file']}")
+                for entry in chapter_entries
+            ]
         else:
             print(f"[WARNING] No matching BibTeX entry found for book: {title}")
     else:
         print(f"[WARNING] No book metadata found for YAML header generation")
 
+    # --- PHASE 3: Markdown Cleanup & Cross-Link Rewriting Phase ---
+    # Apply clean_markdown_text() (excluding link conversion), then again with the
+    # complete chapter_map to replace internal [text](chapter.xhtml#anchor) links with
+    # Obsidian [[filename]] links. The cleanup rules are not idempotent (the second
+    # application repairs artifacts left by the first), so both applications are kept,
+    # but chained in memory and written to disk once, behind the chapter's YAML header.
+    # The cleanup is CPU-bound pure Python, so chapters are cleaned in worker processes.
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for entry, yaml_header, _ in zip(chapter_entries, yaml_headers, executor.map(
+            clean_chapter_file,
+            [converted[entry["source_files"][0]] for entry in chapter_entries],
+            repeat(chapter_map),
+            [output_dir / entry["output_file"] for entry in chapter_entries],
+            yaml_headers
+        )):
+            print(f"[Phase 3] Cleaned markdown: {entry['output_file']}")
+            if yaml_header is not None:
+                print(f"[Phase 5] Added YAML header to: {entry['output_file']}")
+
     # Add runtime metadata before writing log
-    from datetime import datetime
     end_timestamp = datetime.utcnow().isoformat() + "Z"
     conversion_log["end_time_utc"] = end_timestamp
     conversion_log["total_output_files"] = len(conversion_log["chapters"])
 
     # Create timestamped log filename
-    from datetime import datetime
     timestamp = datetime.now().strftime("%Y-%m-%d_%H.%M")
     # Use book title for log filename if available, otherwise use EPUB filename
     if book_title:
@@ -2007,13 +2355,16 @@ def main():
         log_path = LOG_DIR / f"{safe_log_title}_{timestamp}.json"
     else:
         log_path = LOG_DIR / f"{epub_file.stem}_{timestamp}.json"
-    with open(log_path, "w", encoding="utf-8") as f:
-        json.dump(conversion_log, f, indent=2)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    # Serialize in one call and write in one go (json.dump issues a write per encoded chunk)
+    if orjson is not None:
+        log_path.write_bytes(orjson.dumps(conversion_log, option=orjson.OPT_INDENT_2))
+    else:
+        log_path.write_text(json.dumps(conversion_log, indent=2), encoding="utf-8")
     print(f"Log saved to: {log_path}")
 
     return conversion_log
 
-import time
 if __name__ == "__main__":
     start_time = time.time()
     # Run main() and capture conversion log
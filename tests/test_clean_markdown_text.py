@@ -0,0 +1,28 @@
+"""Pins clean_markdown_text() output for the post-processing rules that were merged or deduplicated."""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from convert_epub_to_md import clean_markdown_text
+
+
+@pytest.mark.parametrize("markdown, expected", [
+    # Table X.Y_#anchor → [Table X.Y](#anchor), then the internal link is reduced to its text
+    ("See Table 2.2_#ch02-table2-2 for details.\n", "See Table 2.2 for details.\n"),
+    ("See Table 2.2_#ch02-table2-2, then Figure 3.1_#fig3-1 below.\n", "See Table 2.2, then Figure 3.1 below.\n"),
+    # Stray parentheses (one combined pattern with a lookup of replacements)
+    ("Smith, J. (2010) experiencing) perceiving them) explicitly\n",
+     "Smith, J. (2010) experiencing (perceiving them (explicitly\n"),
+    ("We hold this position)\n\nNext paragraph\n", "We hold this position\n\nNext paragraph\n"),
+    # Missing closing parentheses on the known incomplete sentences
+    ("It is (about the concept.\n) Next sentence.\n", "It is (about the concept.) Next sentence.\n"),
+    ("A question (understanding the chair?\n) follows.\n", "A question (understanding the chair?) follows.\n"),
+    # ) left after a heading at the end of a section
+    ("Closing words (see above)\n\n# Summary\n\n) continues here\n",
+     "Closing words (see above)\n\n# Summary continues here\n"),
+])
+def test_merged_rules(markdown, expected):
+    assert clean_markdown_text(markdown) == expected
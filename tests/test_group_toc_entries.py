@@ -0,0 +1,50 @@
+"""Checks that back matter set aside before TOC-driven grouping is still labeled and written."""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from convert_epub_to_md import group_toc_entries
+
+XHTML = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{title}</title></head>
+<body><section id="{stem}"><h1>{title}</h1><p>Text.</p></section></body></html>
+"""
+
+
+def write_book(folder: Path, files: dict) -> dict:
+    for name, title in files.items():
+        (folder / name).write_text(XHTML.format(title=title, stem=Path(name).stem), encoding="utf-8")
+    return dict(files)
+
+
+def test_back_matter_file_name_with_other_title(tmp_path):
+    titles = write_book(tmp_path, {
+        "ch1.xhtml": "CHAPTER 1 Introduction",
+        "ch2.xhtml": "CHAPTER 2 Methods",
+        "references.xhtml": "Bibliography",
+    })
+    toc_entries = [
+        ("ch1.xhtml", "", "CHAPTER 1 Introduction", 1),
+        ("ch2.xhtml", "", "CHAPTER 2 Methods", 1),
+        ("references.xhtml", "", "Bibliography", 1),
+    ]
+    chapter_groups, front_matter, back_matter = group_toc_entries(toc_entries, titles, tmp_path)
+    assert back_matter == ["references.xhtml"]
+    assert all("references.xhtml" not in files for _, _, files in chapter_groups)
+
+
+def test_back_matter_by_title_and_file_name_listed_once(tmp_path):
+    titles = write_book(tmp_path, {
+        "ch1.xhtml": "CHAPTER 1 Introduction",
+        "gloss.xhtml": "Glossary",
+        "12_index.xhtml": "Subject Terms",
+    })
+    toc_entries = [
+        ("ch1.xhtml", "", "CHAPTER 1 Introduction", 1),
+        ("gloss.xhtml", "a", "Glossary", 1),
+        ("gloss.xhtml", "b", "Glossary B", 2),
+        ("12_index.xhtml", "", "Subject Terms", 1),
+    ]
+    _, _, back_matter = group_toc_entries(toc_entries, titles, tmp_path)
+    assert back_matter == ["gloss.xhtml", "12_index.xhtml"]